@@ -1,7 +1,20 @@
+import logging
+import os
 from pathlib import Path
 
 ROOT_DIR = Path(__file__).parent.parent
-VAR_DIR = ROOT_DIR / "var"
-DATA_DIR = ROOT_DIR / "data"
+# Overridable to run an instance on other data, such as benchmarks do
+VAR_DIR = Path(os.environ.get("GOTY_VAR_DIR", ROOT_DIR / "var"))
+DATA_DIR = Path(os.environ.get("GOTY_DATA_DIR", ROOT_DIR / "data"))
 
 VAR_DIR.mkdir(parents=True, exist_ok=True)
+
+# Logs of the site, printed along those of uvicorn whatever the root logger
+# is configured with
+logger = logging.getLogger("goty")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+if not logger.handlers:
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(levelname)s:     %(message)s"))
+    logger.addHandler(handler)
@@ -0,0 +1,40 @@
+"""
+Run the site with uvicorn, with as many worker processes as configured:
+
+    python -m app [--host HOST] [--port PORT] [--workers N]
+"""
+
+from argparse import ArgumentParser
+
+import uvicorn
+
+from app.config import config
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--host", default=config.host)
+    parser.add_argument("--port", type=int, default=config.port)
+    parser.add_argument("--workers", type=int, default=config.workers)
+    args = parser.parse_args()
+
+    if args.workers > 1 and config.vote_store != "sqlite":
+        raise Exception(
+            f"The {config.vote_store!r} vote store can't be shared by several "
+            "workers, use the 'sqlite' one"
+        )
+    if args.workers > 1 and config.session_store != "sqlite":
+        raise Exception(
+            f"The {config.session_store!r} session store can't be shared by "
+            "several workers, use the 'sqlite' one"
+        )
+    if config.debug:
+        print("Running in debug mode, set debug to false in production")
+    uvicorn.run(
+        "app.application:app",
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        # Behind a reverse proxy, for the callback URLs sent to Discord
+        proxy_headers=True,
+        log_level="debug" if config.debug else "info",
+    )
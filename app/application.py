@@ -1,30 +1,127 @@
+import asyncio
 import contextlib
+import datetime
+import hashlib
+import threading
 import time
+import typing as t
 
 import flask
 import rapidfuzz
-import yaml
 from fastapi import FastAPI, Request
 from fastapi.middleware.wsgi import WSGIMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from flask import Flask
 from pydantic import BaseModel
 
-from app import discord, votes
+from app import (
+    catalog,
+    discord,
+    export,
+    logger,
+    metrics,
+    sessions,
+    vote_store,
+    votes,
+)
 from app.config import config, secret_key
-from app.models.game import Game
 
 front = Flask(__name__, template_folder="templates")
-front.debug = True
+front.debug = config.debug
 front.config["SECRET_KEY"] = secret_key
-front.config["TEMPLATES_AUTO_RELOAD"] = True
-front.config["DEBUG"] = True
-app = FastAPI()
+front.config["TEMPLATES_AUTO_RELOAD"] = config.debug
+front.config["DEBUG"] = config.debug
+front.session_interface = sessions.ServerSessionInterface(
+    sessions.SQLiteSessionStore(config.session_ttl)
+    if config.session_store == "sqlite"
+    else sessions.MemorySessionStore(
+        config.session_ttl, config.session_cache_size
+    )
+)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    if config.catalog_reload_interval:
+        catalog.watch(config.catalog_reload_interval)
+    yield
+    await discord.close_async_client()
+
+
+app = FastAPI(lifespan=lifespan)
 api = FastAPI()
 
+
+@app.get("/metrics")
+def get_metrics():
+    if not config.expose_metrics:
+        return Response("Not Found", status_code=404)
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
 app.mount("/api", api)
 app.mount("/", WSGIMiddleware(front))
 
+search_seconds = metrics.Histogram(
+    "search_duration_seconds", "Time spent ranking the games matching a search"
+)
+template_seconds = metrics.Histogram(
+    "template_render_duration_seconds",
+    "Time spent rendering templates, by template",
+)
+metrics.caches["search"] = lambda: (
+    catalog.get().search_cache.hits,
+    catalog.get().search_cache.misses,
+)
+
+
+@api.middleware("http")
+async def time_api_request(request: Request, call_next):
+    start = time.perf_counter()
+    # Unhandled exceptions are only turned into responses further out
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        metrics.request_seconds.observe(
+            time.perf_counter() - start,
+            method=request.method,
+            route="/api" + route.path if route else "unmatched",
+            status=status,
+        )
+
+
+@front.before_request
+def start_request_timer():
+    flask.g.request_start = time.perf_counter()
+
+
+@front.after_request
+def time_request(response: flask.Response):
+    rule = flask.request.url_rule
+    metrics.request_seconds.observe(
+        time.perf_counter() - flask.g.request_start,
+        method=flask.request.method,
+        route=rule.rule if rule else "unmatched",
+        status=response.status_code,
+    )
+    return response
+
+
+@flask.before_render_template.connect_via(front)
+def start_template_timer(sender, template, context, **kwargs):
+    flask.g.template_start = time.perf_counter()
+
+
+@flask.template_rendered.connect_via(front)
+def time_template(sender, template, context, **kwargs):
+    template_seconds.observe(
+        time.perf_counter() - flask.g.template_start, template=template.name
+    )
+
 
 @front.context_processor
 def flask_globals():
@@ -36,10 +133,11 @@ def flask_globals():
             redirect_uri=flask.url_for("discord_callback", _external=True),
         )
     access_token = flask.session.get("discord_access_token")
-    if access_token:
+    user = flask.session.get("discord_user")
+    if access_token and user:
+        # Resolved once when logging in, so pages don't wait for Discord
+        discord_user = discord.API.User.model_validate(user)
         result["discord_access_token"] = access_token
-        discord_api = discord.API(access_token=access_token)
-        discord_user = discord_api.get_user()
         result["discord_user"] = discord_user
         result["user_votes"] = votes.get_user_votes(user_id=discord_user.id)
 
@@ -57,11 +155,8 @@ def timed(title=None):
         print(title or "Task", f"done in {time.monotonic() - now}s")
 
 
-with timed("Loading games from file"):
-    with config.get_games_path().open() as f:
-        games_by_name = {
-            game["name"]: Game(**game) for game in yaml.safe_load(f)
-        }
+with timed("Loading games"):
+    catalog.get()
 
 
 @front.route("/")
@@ -69,41 +164,112 @@ def index():
     return flask.render_template("index.html.j2")
 
 
-@front.route("/results/")
-@front.route("/results/<genre>")
-def results(genre=None):
-    if not config.allow_viewing_results:
-        return "Viewing results is not allowed", 403
-    if genre:
-        genre = genre.capitalize()
-    votes_data = votes.load()
-    votes_by_game = {}
-    voting_users = set()
-    with discord.DB_PATH.open() as f:
-        users_data = yaml.safe_load(f)
-    for vote in votes_data:
-        votes_by_game.setdefault(vote.game_name, [])
-        votes_by_game[vote.game_name].append(vote)
-        voting_users.add(users_data[vote.user_id])
-    top = votes.get_top(genre=genre)
+class RenderedPage(t.NamedTuple):
+    key: tuple
+    html: str
+    etag: str
+    last_modified: datetime.datetime
+
+
+# Rendered results pages by year and category, only used outside of debug
+# mode
+results_cache: dict[tuple[int | None, str | None], RenderedPage] = {}
+results_cache_lock = threading.Lock()
+results_cache_counts = {"hits": 0, "misses": 0}
+metrics.caches["results"] = lambda: (
+    results_cache_counts["hits"],
+    results_cache_counts["misses"],
+)
+
+
+def render_results(genre=None, year=None):
+    users_data = discord.get_user_names()
+    leaderboard = votes.get_leaderboard(year)
+    games = catalog.get(year)
     result = [
         {
             "votes": [
-                users_data[vote.user_id]
-                for vote in votes_by_game[game]
-                if not vote.hidden
+                users_data.get(user_id, user_id)
+                for user_id in leaderboard.get_voters(game)
             ],
             "score": score,
-            "game": games_by_name[game],
+            "game": games.games_by_name[game],
         }
-        for game, score in top
+        for game, score in leaderboard.get_top(genre)
+        # The leaderboard catches up with a new catalog right after it
+        if game in games.games_by_name
     ]
     return flask.render_template(
         "results.html.j2",
         data=result,
         category=genre or "Free",
-        stats={"participants": len(voting_users)},
+        year=games.year,
+        results_url=(
+            flask.url_for("results")
+            if games.year == config.year
+            else flask.url_for("archived_results", year=games.year)
+        ),
+        stats={"participants": len(leaderboard.participants)},
+    )
+
+
+def get_results_page(genre=None, year=None) -> RenderedPage:
+    # Everything the results depend on
+    key = (
+        votes.get_leaderboard(year).store.version,
+        discord.get_user_names_version(),
+        catalog.get(year).version,
     )
+    page = results_cache.get((year, genre))
+    if page and page.key == key:
+        results_cache_counts["hits"] += 1
+        return page
+    with results_cache_lock:
+        page = results_cache.get((year, genre))
+        if page and page.key == key:
+            results_cache_counts["hits"] += 1
+            return page
+        results_cache_counts["misses"] += 1
+        html = render_results(genre, year)
+        page = RenderedPage(
+            key=key,
+            html=html,
+            etag=hashlib.sha1(html.encode()).hexdigest(),
+            last_modified=datetime.datetime.now(datetime.timezone.utc),
+        )
+        results_cache[(year, genre)] = page
+        return page
+
+
+def serve_results(genre=None, year=None):
+    if genre:
+        genre = genre.capitalize()
+    if config.debug:
+        return render_results(genre, year)
+    page = get_results_page(genre, year)
+    response = flask.make_response(page.html)
+    response.set_etag(page.etag)
+    response.last_modified = page.last_modified
+    response.cache_control.no_cache = True
+    return response.make_conditional(flask.request)
+
+
+@front.route("/results/")
+@front.route("/results/<genre>")
+def results(genre=None):
+    if not config.allow_viewing_results:
+        return "Viewing results is not allowed", 403
+    return serve_results(genre)
+
+
+@front.route("/archive/<int:year>/results/")
+@front.route("/archive/<int:year>/results/<genre>")
+def archived_results(year: int, genre=None):
+    if year >= config.year or year not in catalog.get_years():
+        return f"No archived results for {year}", 404
+    if not vote_store.get_archive_path(year).exists():
+        return f"No archived results for {year}", 404
+    return serve_results(genre, year)
 
 
 @front.route("/auth/discord/callback")
@@ -117,13 +283,20 @@ def discord_callback():
         redirect_uri=flask.url_for("discord_callback", _external=True),
         code=code,
     )
+    discord_api = discord.API(access_token=token_response.access_token)
+    discord_user = discord_api.get_user()
+    flask.session.rotate()
     flask.session["discord_access_token"] = token_response.access_token
+    flask.session["discord_user"] = discord_user.model_dump(mode="json")
     return flask.redirect(flask.url_for("index"))
 
 
 @front.route("/auth/discord/logout")
 def discord_logout():
-    token = flask.session.pop("discord_access_token", None)
+    token = flask.session.get("discord_access_token")
+    flask.session.clear()
+    if token:
+        discord.forget_token(token)
     # if token:
     #     discord.revoke_token(
     #         client_id=config.discord.client_id,
@@ -133,6 +306,20 @@ def discord_logout():
     return flask.redirect(flask.url_for("index"))
 
 
+@front.errorhandler(discord.RateLimited)
+def rate_limited_handler(exc: discord.RateLimited):
+    return str(exc), 429, {"Retry-After": str(int(exc.retry_after) + 1)}
+
+
+@api.exception_handler(discord.RateLimited)
+async def api_rate_limited_handler(request: Request, exc: discord.RateLimited):
+    return JSONResponse(
+        status_code=429,
+        content={"message": f"{exc}"},
+        headers={"Retry-After": str(int(exc.retry_after) + 1)},
+    )
+
+
 @api.exception_handler(Exception)
 async def api_exception_handler(request: Request, exc: Exception):
     return JSONResponse(
@@ -143,17 +330,22 @@ async def api_exception_handler(request: Request, exc: Exception):
 
 @api.get("/games/")
 def api_games(q: str):
-    if not q:
+    query = rapidfuzz.utils.default_process(q)
+    if not query:
         return []
-    matches = rapidfuzz.process.extract(
-        q,
-        games_by_name.keys(),
-        scorer=rapidfuzz.fuzz.WRatio,
-        processor=rapidfuzz.utils.default_process,
-        limit=12,
-    )
-    print(f"Matches for {q}: {matches}")
-    return [games_by_name[result[0]].model_dump() for result in matches]
+    # Held for the whole request, a reload can't mix two catalogs
+    games = catalog.get()
+    content = games.search_cache.get(query)
+    if content is None:
+        with search_seconds.time():
+            matches = games.search_index.search(query)
+        if metrics.sample(config.log_sample_rate):
+            logger.info(f"Matches for {q}: {matches}")
+        content = (
+            "[" + ",".join(games.payloads[name] for name, _ in matches) + "]"
+        ).encode()
+        games.search_cache.set(query, content)
+    return Response(content=content, media_type="application/json")
 
 
 class VoteBody(BaseModel):
@@ -162,16 +354,16 @@ class VoteBody(BaseModel):
 
 
 @api.post("/vote/")
-def add_vote(
+async def add_vote(
     body: VoteBody,
 ):
     if config.disable_voting:
         raise Exception("Voting is currently disabled")
-    discord_api = discord.API(access_token=body.discord_access_token)
-    discord_user = discord_api.get_user()
+    discord_api = discord.AsyncAPI(access_token=body.discord_access_token)
+    discord_user = await discord_api.get_user()
     user_id = discord_user.id
 
-    votes.add(
+    await votes.add_async(
         game_name=body.game_name,
         user_id=user_id,
     )
@@ -184,16 +376,16 @@ class PatchVoteBody(BaseModel):
 
 
 @api.patch("/vote/")
-def patch_vote(
+async def patch_vote(
     body: PatchVoteBody,
 ):
     if config.disable_voting:
         raise Exception("Voting is currently disabled")
-    discord_api = discord.API(access_token=body.discord_access_token)
-    discord_user = discord_api.get_user()
+    discord_api = discord.AsyncAPI(access_token=body.discord_access_token)
+    discord_user = await discord_api.get_user()
     user_id = discord_user.id
 
-    votes.set_hidden(
+    await votes.set_hidden_async(
         game_name=body.game_name,
         user_id=user_id,
         hidden=body.hidden,
@@ -201,16 +393,76 @@ def patch_vote(
 
 
 @api.delete("/vote/")
-def add_vote(
+async def delete_vote(
     body: VoteBody,
 ):
     if config.disable_voting:
         raise Exception("Voting is currently disabled")
-    discord_api = discord.API(access_token=body.discord_access_token)
-    discord_user = discord_api.get_user()
+    discord_api = discord.AsyncAPI(access_token=body.discord_access_token)
+    discord_user = await discord_api.get_user()
     user_id = discord_user.id
 
-    votes.delete(
+    await votes.delete_async(
         game_name=body.game_name,
         user_id=user_id,
     )
+
+
+class AdminBody(BaseModel):
+    discord_access_token: str
+
+
+@api.post("/admin/catalog/reload")
+async def reload_catalog(body: AdminBody):
+    discord_api = discord.AsyncAPI(access_token=body.discord_access_token)
+    discord_user = await discord_api.get_user()
+    if discord_user.id not in config.admin_user_ids:
+        raise Exception("Only admins can reload the catalog")
+    reloaded = await asyncio.to_thread(catalog.reload, force=True)
+    games = catalog.get()
+    return {
+        "reloaded": reloaded,
+        "version": games.version,
+        "games": len(games.games_by_name),
+    }
+
+
+class ExportBody(AdminBody):
+    format: str = "ndjson"
+    year: int | None = None
+    category: str | None = None
+    since: datetime.datetime | None = None
+    until: datetime.datetime | None = None
+
+
+def get_export(kind: str, year: int | None, **kwargs):
+    # Loading the catalog builds the leaderboard of its year
+    catalog.get(year)
+    return export.export(kind, votes.get_leaderboard(year), **kwargs)
+
+
+@api.post("/admin/export/{kind}")
+async def export_votes(kind: str, body: ExportBody):
+    discord_api = discord.AsyncAPI(access_token=body.discord_access_token)
+    discord_user = await discord_api.get_user()
+    if discord_user.id not in config.admin_user_ids:
+        raise Exception("Only admins can export votes")
+    chunks = await asyncio.to_thread(
+        get_export,
+        kind,
+        format=body.format,
+        year=body.year,
+        category=body.category,
+        since=body.since,
+        until=body.until,
+    )
+    year = body.year or config.year
+    return StreamingResponse(
+        chunks,
+        media_type=export.FORMATS[body.format],
+        headers={
+            "Content-Disposition": (
+                f'attachment; filename="{kind}_{year}.{body.format}"'
+            )
+        },
+    )
@@ -0,0 +1,58 @@
+import threading
+import time
+import typing as t
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Thread-safe mapping keeping at most `maxsize` entries, evicting the least
+    recently used one first. Entries older than `ttl` seconds are no longer
+    returned by `get`, but stay available to `get_stale` until evicted. A
+    `ttl` of None never expires entries.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float | None = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[t.Hashable, tuple[float, t.Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key: t.Hashable, default=None):
+        with self._lock:
+            expires_at, value = self._data.get(key, (None, MISSING))
+            if value is MISSING or (
+                expires_at is not None and expires_at < time.monotonic()
+            ):
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def get_stale(self, key: t.Hashable, default=None):
+        with self._lock:
+            return self._data.get(key, (None, default))[1]
+
+    def set(self, key: t.Hashable, value):
+        expires_at = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key: t.Hashable, default=None):
+        with self._lock:
+            return self._data.pop(key, (None, default))[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
@@ -0,0 +1,273 @@
+import functools
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import typing as t
+from pathlib import Path
+
+import yaml
+
+from app import DATA_DIR
+from app.cache import TTLCache
+from app.config import config
+from app.models.game import Game, GameRecord
+from app.search import SearchIndex
+
+# Bump when the compiled format or the Game model changes incompatibly
+COMPILED_VERSION = 1
+YAMLLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+def get_source_hash(path: Path) -> str:
+    with path.open("rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def write_compiled(games: t.Iterable[Game], path: Path, source_hash: str):
+    """
+    Write games as JSON lines, after a header line holding the format version
+    and the hash of the YAML catalog they were compiled from.
+    """
+    # Named after no one else's, workers and the reload watcher may all be
+    # compiling the catalog at once
+    with tempfile.NamedTemporaryFile(
+        "w", dir=path.parent, prefix=path.name, suffix=".tmp", delete=False
+    ) as f:
+        try:
+            header = {"version": COMPILED_VERSION, "source_hash": source_hash}
+            f.write(json.dumps(header) + "\n")
+            f.writelines(dump_game(game) for game in games)
+        except BaseException:
+            os.unlink(f.name)
+            raise
+    os.replace(f.name, path)
+
+
+def dump_game(game: Game) -> str:
+    return (
+        game.model_dump_json(
+            exclude=set(Game.model_computed_fields), exclude_none=True
+        )
+        + "\n"
+    )
+
+
+def read_compiled(path: Path, source_hash: str) -> t.Iterator[Game] | None:
+    """
+    Return None if the compiled catalog is missing or stale. Games are read as
+    they are iterated over, so that they can be converted one at a time.
+    """
+    if not path.exists():
+        return None
+    f = path.open()
+    header = json.loads(f.readline() or "{}")
+    if (
+        header.get("version") != COMPILED_VERSION
+        or header.get("source_hash") != source_hash
+    ):
+        f.close()
+        return None
+    return iter_compiled(f)
+
+
+def iter_compiled(f: t.TextIO) -> t.Iterator[Game]:
+    with f:
+        for line in f:
+            yield Game.model_validate_json(line)
+
+
+def read_yaml(path: Path) -> list[Game]:
+    with path.open() as f:
+        return [Game(**game) for game in yaml.load(f, Loader=YAMLLoader)]
+
+
+def compile_games(year=None) -> list[Game]:
+    source_path = config.get_games_path(year)
+    games = read_yaml(source_path)
+    write_compiled(
+        games,
+        config.get_compiled_games_path(year),
+        get_source_hash(source_path),
+    )
+    return games
+
+
+def load_games(year=None, source_hash=None) -> t.Iterable[Game]:
+    """
+    Load the catalog of a year from its compiled form, falling back to the
+    YAML catalog, and compiling it, when the compiled one is missing or stale.
+    """
+    source_path = config.get_games_path(year)
+    compiled_path = config.get_compiled_games_path(year)
+    source_hash = source_hash or get_source_hash(source_path)
+    games = read_compiled(compiled_path, source_hash)
+    if games is not None:
+        return games
+    print(f"Compiled catalog {compiled_path} is missing or stale")
+    games = read_yaml(source_path)
+    try:
+        write_compiled(games, compiled_path, source_hash)
+    except OSError as e:
+        print(f"Could not write compiled catalog {compiled_path}: {e}")
+    return games
+
+
+def get_category(genres: t.Iterable[str]) -> str | None:
+    """First of the genres having its own votes quota, if any."""
+    for genre in genres:
+        if genre in config.votes_per_genre_per_user:
+            return genre
+    return None
+
+
+class Catalog:
+    """
+    Games of the catalog of a year and everything derived from them. A catalog
+    is never modified once built: reloading builds a new one, so that a
+    request using a catalog sees the same version of it throughout.
+
+    What is only needed to search games is built on first use, which archived
+    years, where voting is over, never get to.
+    """
+
+    def __init__(self, games: t.Iterable[Game], version: str, year: int):
+        self.version = version
+        self.year = year
+        self.games_by_name = {
+            game.name: GameRecord.from_game(game, get_category(game.genres))
+            for game in games
+        }
+        self.last_used = time.monotonic()
+
+    @functools.cached_property
+    def payloads(self) -> dict[str, str]:
+        """Each game's JSON, as served by the games search API."""
+        return {
+            name: game.dump_json() for name, game in self.games_by_name.items()
+        }
+
+    @functools.cached_property
+    def search_index(self) -> SearchIndex:
+        return SearchIndex(
+            self.games_by_name,
+            limit=config.search.limit,
+            score_cutoff=config.search.score_cutoff,
+            max_candidates=config.search.max_candidates,
+        )
+
+    @functools.cached_property
+    def search_cache(self) -> TTLCache:
+        return TTLCache(maxsize=config.search.cache_size)
+
+
+# Loaded catalogs by year
+_catalogs: dict[int, Catalog] = {}
+_reload_lock = threading.Lock()
+# Called with the new catalog after each reload
+listeners: list[t.Callable[[Catalog], None]] = []
+# Called with the year of each catalog unloaded for being idle
+unload_listeners: list[t.Callable[[int], None]] = []
+
+
+def get(year=None) -> Catalog:
+    year = year or config.year
+    catalog = _catalogs.get(year)
+    if catalog is None:
+        reload(year)
+        catalog = _catalogs[year]
+        catalog.last_used = time.monotonic()
+        evict_idle()
+    catalog.last_used = time.monotonic()
+    return catalog
+
+
+def get_years() -> list[int]:
+    """Years having a games catalog, most recent first."""
+    years = []
+    for path in DATA_DIR.glob("goty_*_games.yml"):
+        year = path.name.split("_")[1]
+        if year.isdigit():
+            years.append(int(year))
+    return sorted(years, reverse=True)
+
+
+def reload(year=None, force=False) -> bool:
+    """
+    Build a new catalog if the games file of a year changed, and swap it in.
+    Return whether the catalog was replaced.
+    """
+    year = year or config.year
+    with _reload_lock:
+        path = config.get_games_path(year)
+        if not path.exists():
+            raise Exception(f"No games catalog for {year}")
+        source_hash = get_source_hash(path)
+        current = _catalogs.get(year)
+        if current and current.version == source_hash and not force:
+            return False
+        start = time.monotonic()
+        catalog = Catalog(
+            load_games(year, source_hash=source_hash), source_hash, year
+        )
+        _catalogs[year] = catalog
+        print(
+            f"Loaded {year} catalog {source_hash[:8]} with "
+            f"{len(catalog.games_by_name)} games in "
+            f"{time.monotonic() - start:.2f}s"
+        )
+        for listener in listeners:
+            listener(catalog)
+        return True
+
+
+def evict_idle():
+    """Forget the catalogs of past years that were not used in a while."""
+    deadline = time.monotonic() - config.catalog_idle_timeout
+    for year, catalog in list(_catalogs.items()):
+        if year != config.year and catalog.last_used < deadline:
+            print(f"Unloading idle {year} catalog")
+            _catalogs.pop(year, None)
+            for listener in unload_listeners:
+                listener(year)
+
+
+def watch(interval: float):
+    """
+    From a background thread, reload the catalog of the current year when its
+    file changes, and unload idle catalogs.
+    """
+
+    def run():
+        path = config.get_games_path()
+        mtime = path.stat().st_mtime
+        while True:
+            time.sleep(interval)
+            try:
+                new_mtime = path.stat().st_mtime
+                if new_mtime != mtime:
+                    mtime = new_mtime
+                    reload()
+                evict_idle()
+            except Exception as e:
+                print(f"Failed to reload catalog: {e}")
+
+    thread = threading.Thread(target=run, name="catalog-watcher", daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Compile a YAML games catalog")
+    parser.add_argument("year", type=int, nargs="?", default=config.year)
+    args = parser.parse_args()
+
+    games = compile_games(args.year)
+    print(
+        f"Compiled {len(games)} games to "
+        f"{config.get_compiled_games_path(args.year)}"
+    )
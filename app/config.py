@@ -1,4 +1,5 @@
 import secrets
+import typing as t
 from datetime import datetime
 
 import yaml
@@ -15,24 +16,71 @@ class Config(BaseModel):
         client_id: str | None = Field(None, coerce_numbers_to_str=True)
         client_secret: str | None = None
         server_id: str | None = Field(None, coerce_numbers_to_str=True)
+        base_url: str = "https://discord.com"
+        user_cache_size: int = 10_000
+        user_cache_ttl: int = 300
+        pool_size: int = 32
+        timeout: float = 10
+        max_retries: int = 2
+        max_rate_limit_wait: float = 5
 
     class IGDB(BaseModel):
         client_id: str | None = None
         client_secret: str | None = None
+        api_url: str | None = None
+        auth_url: str | None = None
+
+    class Search(BaseModel):
+        limit: int = 12
+        score_cutoff: float = 0
+        max_candidates: int = 300
+        cache_size: int = 4096
 
     discord: Discord = Discord()
     igdb: IGDB = IGDB()
+    search: Search = Search()
 
     votes_per_user: int = 3
     votes_per_genre_per_user: dict[str, int] = {"Music": 1}
     year: int = datetime.now().year
+    debug: bool = True
+    host: str = "127.0.0.1"
+    port: int = 8000
+    workers: int = 1
     disable_voting: bool = False
     allow_viewing_results: bool = False
+    # "log" for a single process, "sqlite" to share votes and user names
+    # between several workers
+    vote_store: str = "log"
+    vote_batch_window: float = 0.002
+    # Where logged in sessions are kept, "memory" for a single process,
+    # "sqlite" to share them between several workers
+    session_store: str = "memory"
+    # Seconds a login lasts, as long as a Discord access token
+    session_ttl: int = 604800
+    session_cache_size: int = 100_000
+    # Ballot summaries of the users who recently viewed a page
+    user_votes_cache_size: int = 10_000
+    # Seconds between checks of the games file for changes, 0 to disable
+    catalog_reload_interval: float = 5
+    # Seconds after which the catalog of a past year is unloaded if unused
+    catalog_idle_timeout: float = 600
+    # Serve /metrics, to be restricted to the scraper by the reverse proxy
+    expose_metrics: bool = False
+    # Share of frequent events, such as searches and votes, that get logged
+    log_sample_rate: float = 0.01
+    admin_user_ids: list[
+        t.Annotated[str, Field(coerce_numbers_to_str=True)]
+    ] = []
 
     def get_games_path(self, year=None) -> str:
         year = year or self.year
         return DATA_DIR / f"goty_{year}_games.yml"
 
+    def get_compiled_games_path(self, year=None) -> str:
+        year = year or self.year
+        return DATA_DIR / f"goty_{year}_games.jsonl"
+
 
 if not SECRET_KEY_FILE.exists():
     secret_key = secrets.token_hex(32)
@@ -0,0 +1,57 @@
+import contextlib
+import sqlite3
+import threading
+from pathlib import Path
+
+from app import VAR_DIR
+
+DB_PATH = VAR_DIR / "goty.db"
+
+
+class Database:
+    """
+    SQLite database shared by every process of the site, in WAL mode so that
+    readers never wait for the writer. Each thread gets its own connection.
+    Transactions are explicit: outside of `transaction`, each statement
+    commits on its own.
+    """
+
+    def __init__(self, path: Path = DB_PATH, schema: str = ""):
+        self.path = path
+        self.schema = schema
+        self._local = threading.local()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(
+                self.path, isolation_level=None, timeout=30
+            )
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = FULL")
+            connection.executescript(self.schema)
+            self._local.connection = connection
+        return connection
+
+    def execute(self, sql: str, parameters=()) -> sqlite3.Cursor:
+        return self.connection.execute(sql, parameters)
+
+    @contextlib.contextmanager
+    def transaction(self, immediate=False):
+        """
+        Run the block in a transaction, rolled back if it raises. Immediate
+        transactions take the write lock right away, holding off writers of
+        the other processes for the whole block.
+        """
+        connection = self.connection
+        if connection.in_transaction:
+            yield connection
+            return
+        connection.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+        try:
+            yield connection
+        except BaseException:
+            connection.rollback()
+            raise
+        connection.commit()
@@ -1,23 +1,275 @@
+import asyncio
+import hashlib
 import logging
+import threading
+import time
 import typing as t
 import urllib
 from pathlib import Path
 
-import requests
+import httpx
 import yaml
 from pydantic import BaseModel as Model
 from requests import Session
+from requests.adapters import HTTPAdapter
 
-from app import VAR_DIR
+from app import VAR_DIR, database, metrics
+from app.cache import TTLCache
+from app.config import config
 
 DB_PATH = VAR_DIR / "discord.yml"
-BASE_URL = "https://discord.com"
+BASE_URL = config.discord.base_url.rstrip("/")
 API_URL = f"{BASE_URL}/api/v10"
 CDN_URL = "https://cdn.discordapp.com"
 SCOPES = ("email", "identify")
 
+# Every sync call to Discord goes through this pool. Failed connections are
+# retried by the adapter, rate limited requests by `send`.
 session = Session()
-session.headers["Content-Type"] = "application/x-www-form-urlencoded"
+session.mount(
+    BASE_URL,
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=config.discord.pool_size,
+        max_retries=config.discord.max_retries,
+    ),
+)
+
+request_seconds = metrics.Histogram(
+    "discord_request_duration_seconds",
+    "Time spent in Discord API calls, by method and path",
+)
+rate_limited = metrics.Counter(
+    "discord_rate_limited_total", "Discord API calls that were rate limited"
+)
+
+# Keyed by a hash of the access token, so tokens never sit in memory as keys
+user_cache = TTLCache(
+    maxsize=config.discord.user_cache_size, ttl=config.discord.user_cache_ttl
+)
+metrics.caches["discord_users"] = lambda: (user_cache.hits, user_cache.misses)
+
+
+class UserNames:
+    """
+    Names of the users who logged in, by user id, kept in a YAML file that
+    only one process may use.
+    """
+
+    def __init__(self, path: Path = DB_PATH):
+        self.path = path
+        self._names: dict[str, str] | None = None
+        self._lock = threading.Lock()
+        # Bumped whenever a user name changes, for caches depending on names
+        self.version = 0
+
+    def get_all(self) -> dict[str, str]:
+        with self._lock:
+            if self._names is None:
+                if self.path.exists():
+                    with self.path.open() as f:
+                        self._names = yaml.safe_load(f) or {}
+                else:
+                    self._names = {}
+            return self._names
+
+    def get_version(self) -> int:
+        return self.version
+
+    def save(self, user_id: str, name: str):
+        names = self.get_all()
+        with self._lock:
+            if names.get(user_id) == name:
+                return
+            names[user_id] = name
+            self.version += 1
+            with self.path.open("w") as f:
+                yaml.dump(names, f)
+
+
+class SQLiteUserNames(UserNames):
+    """
+    Same, in the SQLite database shared by every process. Names are read again
+    whenever another process changed one.
+    """
+
+    # Renaming a user replaces its row, with a new and higher seq
+    schema = """
+        CREATE TABLE IF NOT EXISTS users (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            id TEXT NOT NULL UNIQUE,
+            name TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, path: Path = database.DB_PATH):
+        super().__init__()
+        self.db = database.Database(path, self.schema)
+        self.version = -1
+        if not self.db.execute("SELECT 1 FROM users").fetchone():
+            if DB_PATH.exists():
+                print(f"Importing user names from {DB_PATH}")
+                for user_id, name in UserNames(DB_PATH).get_all().items():
+                    self.save(str(user_id), name)
+
+    def get_version(self) -> int:
+        return self.db.execute(
+            "SELECT coalesce(max(seq), 0) FROM users"
+        ).fetchone()[0]
+
+    def get_all(self) -> dict[str, str]:
+        with self._lock:
+            version = self.get_version()
+            if version != self.version:
+                self._names = dict(
+                    self.db.execute("SELECT id, name FROM users").fetchall()
+                )
+                self.version = version
+            return self._names
+
+    def save(self, user_id: str, name: str):
+        if self.get_all().get(user_id) == name:
+            return
+        self.db.execute(
+            "INSERT OR REPLACE INTO users (id, name) VALUES (?, ?)",
+            (user_id, name),
+        )
+
+
+user_names = SQLiteUserNames() if config.vote_store == "sqlite" else UserNames()
+
+
+def get_user_names() -> dict[str, str]:
+    return user_names.get_all()
+
+
+def get_user_names_version() -> int:
+    return user_names.get_version()
+
+
+def save_user_name(user_id: str, name: str):
+    user_names.save(user_id, name)
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after: float):
+        self.retry_after = retry_after
+        super().__init__(
+            f"Rate limited by Discord, retry in {retry_after:.1f} seconds"
+        )
+
+
+class RateLimits:
+    """
+    When Discord rate limit buckets reset, as told by X-RateLimit-* headers,
+    so that requests wait for a known reset instead of hitting a 429.
+
+    Keys identify a route, and the token it is called with since most user
+    routes are limited per token.
+    """
+
+    def __init__(self):
+        self._resets = TTLCache(maxsize=10_000)
+        self._global_reset = 0
+
+    def get_wait(self, key: t.Hashable) -> float:
+        """Raise RateLimited if the wait is longer than configured."""
+        reset = max(self._global_reset, self._resets.get(key, 0))
+        wait = max(reset - time.monotonic(), 0)
+        if wait > config.discord.max_rate_limit_wait:
+            raise RateLimited(wait)
+        return wait
+
+    def update(self, key: t.Hashable, response) -> float | None:
+        """Return how long to wait before retrying a rate limited response."""
+        headers = response.headers
+        now = time.monotonic()
+        if response.status_code == 429:
+            retry_after = float(headers.get("Retry-After", 1))
+            if (
+                headers.get("X-RateLimit-Global")
+                or headers.get("X-RateLimit-Scope") == "global"
+            ):
+                self._global_reset = now + retry_after
+            else:
+                self._resets.set(key, now + retry_after)
+            return retry_after
+        if headers.get("X-RateLimit-Remaining") == "0":
+            reset_after = float(headers.get("X-RateLimit-Reset-After", 0))
+            self._resets.set(key, now + reset_after)
+        return None
+
+
+rate_limits = RateLimits()
+
+
+def get_path(url: str) -> str:
+    return urllib.parse.urlsplit(url).path.removeprefix("/api/v10")
+
+
+def send(method: str, url: str, key: t.Hashable = None, **kwargs):
+    key = key or (method, url)
+    for _ in range(config.discord.max_retries + 1):
+        time.sleep(rate_limits.get_wait(key))
+        with request_seconds.time(method=method, path=get_path(url)):
+            response = session.request(
+                method, url, timeout=config.discord.timeout, **kwargs
+            )
+        retry_after = rate_limits.update(key, response)
+        if retry_after is None:
+            return response
+        rate_limited.inc()
+        logging.warning(f"Rate limited on {method} {url} for {retry_after}s")
+    raise RateLimited(retry_after)
+
+
+async def send_async(method: str, url: str, key: t.Hashable = None, **kwargs):
+    key = key or (method, url)
+    for _ in range(config.discord.max_retries + 1):
+        await asyncio.sleep(rate_limits.get_wait(key))
+        with request_seconds.time(method=method, path=get_path(url)):
+            response = await get_async_client().request(method, url, **kwargs)
+        retry_after = rate_limits.update(key, response)
+        if retry_after is None:
+            return response
+        rate_limited.inc()
+        logging.warning(f"Rate limited on {method} {url} for {retry_after}s")
+    raise RateLimited(retry_after)
+
+
+_async_client: httpx.AsyncClient | None = None
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """Connection pool shared by every AsyncAPI, kept alive between calls."""
+    global _async_client
+    if _async_client is None:
+        _async_client = httpx.AsyncClient(
+            timeout=config.discord.timeout,
+            limits=httpx.Limits(
+                max_connections=config.discord.pool_size,
+                max_keepalive_connections=config.discord.pool_size,
+            ),
+            transport=httpx.AsyncHTTPTransport(
+                retries=config.discord.max_retries
+            ),
+        )
+    return _async_client
+
+
+async def close_async_client():
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+
+
+def hash_token(access_token: str) -> str:
+    return hashlib.sha256(access_token.encode()).hexdigest()
+
+
+def forget_token(access_token: str):
+    user_cache.pop(hash_token(access_token))
 
 
 class AuthorizationParams(Model):
@@ -30,7 +282,7 @@ class AuthorizationParams(Model):
 
 
 def get_authorization_url(client_id: str, redirect_uri: str, state: str = None):
-    url = "https://discord.com/oauth2/authorize"
+    url = f"{BASE_URL}/oauth2/authorize"
     params = AuthorizationParams(
         client_id=client_id, state=state, redirect_uri=redirect_uri
     )
@@ -41,11 +293,11 @@ def get_authorization_url(client_id: str, redirect_uri: str, state: str = None):
 
 def revoke_token(client_id: str, client_secret: str, token: str):
     url = f"{API_URL}/oauth2/token/revoke"
-    response = session.post(
+    response = send(
+        "POST",
         url,
         data={"token": token},
         auth=(client_id, client_secret),
-        headers={"Content-Type": "application/x-www-form-urlencoded"},
     )
     logging.debug(response.text)
     response.raise_for_status()
@@ -71,7 +323,8 @@ def get_discord_token(
     url = f"{API_URL}/oauth2/token"
     data = AccessTokenRequest(code=code, redirect_uri=redirect_uri)
     logging.debug(f"{url}, {data}")
-    response = session.post(
+    response = send(
+        "POST",
         url,
         data=data.model_dump(),
         auth=(client_id, client_secret),
@@ -95,6 +348,9 @@ class API:
         auth_type = "Bot" if bot else "Bearer"
         self._authorization_header = f"{auth_type} {access_token}"
 
+    def _get_rate_limit_key(self, method, url: str):
+        return (hash_token(self._authorization_header), method, url)
+
     def request(self, method, url: str, data=None, **kwargs):
         api = kwargs.pop("api", True)
         base = API_URL if api else BASE_URL
@@ -102,9 +358,10 @@ class API:
         logging.debug(
             f"{method}, {url}, {kwargs}, {data}, {self._authorization_header}"
         )
-        response = requests.request(
+        response = send(
             method,
             url,
+            key=self._get_rate_limit_key(method, url),
             params=kwargs,
             json=data,
             headers={"Authorization": self._authorization_header},
@@ -160,16 +417,21 @@ class API:
             return f"{CDN_URL}/avatars/{self.id}" f"/{self.avatar}?size=256"
 
     def get_user(self) -> "API.User":
-        data = self.get("/users/@me")
+        key = hash_token(self.access_token)
+        result = user_cache.get(key)
+        if result:
+            return result
+        try:
+            data = self.get("/users/@me")
+        except RateLimited:
+            # Better an identity a bit older than the cache TTL than an error
+            result = user_cache.get_stale(key)
+            if result:
+                return result
+            raise
         result = self.User(**data)
-        if not DB_PATH.exists():
-            db = {}
-        else:
-            with open(DB_PATH, "r") as f:
-                db = yaml.safe_load(f) or {}
-        db[result.id] = result.name
-        with open(DB_PATH, "w") as f:
-            yaml.dump(db, f)
+        user_cache.set(key, result)
+        save_user_name(result.id, result.name)
         return result
 
     def get_oauth(self):
@@ -177,3 +439,45 @@ class API:
 
     def get_bot(self):
         return self.get("/oauth2/applications/@me")
+
+
+class AsyncAPI(API):
+    """Same as API, for use from async code without blocking the loop."""
+
+    async def request(self, method, url: str, data=None, **kwargs):
+        api = kwargs.pop("api", True)
+        base = API_URL if api else BASE_URL
+        url = base + url
+        logging.debug(
+            f"{method}, {url}, {kwargs}, {data}, {self._authorization_header}"
+        )
+        response = await send_async(
+            method,
+            url,
+            key=self._get_rate_limit_key(method, url),
+            params=kwargs,
+            json=data,
+            headers={"Authorization": self._authorization_header},
+        )
+        logging.debug(response.text)
+        response.raise_for_status()
+        if not response.text:
+            return
+        return response.json()
+
+    async def get_user(self) -> API.User:
+        key = hash_token(self.access_token)
+        result = user_cache.get(key)
+        if result:
+            return result
+        try:
+            data = await self.get("/users/@me")
+        except RateLimited:
+            result = user_cache.get_stale(key)
+            if result:
+                return result
+            raise
+        result = self.User(**data)
+        user_cache.set(key, result)
+        await asyncio.to_thread(save_user_name, result.id, result.name)
+        return result
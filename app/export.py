@@ -0,0 +1,296 @@
+"""
+Streaming exports of the votes and results, for tallying them elsewhere:
+
+- votes: every vote, with the category of its game
+- tallies: votes per game, by category, in ranking order
+- voters: voters of each game, by category, hidden votes included
+
+Rows are produced as NDJSON or CSV while the store is read, a chunk at a
+time, so that exports of any size start at once and use little memory:
+
+    python -m app.export votes|tallies|voters [--format ndjson|csv]
+        [--year YEAR] [--category CATEGORY] [--since TIME] [--until TIME]
+        [--output FILE]
+
+The command only reads the vote store, the site can keep running: votes
+cast once it has read them are not exported.
+"""
+
+import contextlib
+import csv
+import datetime
+import json
+import sys
+import typing as t
+from argparse import ArgumentParser
+
+from app import catalog, discord, vote_store
+from app.config import config
+from app.leaderboard import MISSING, Leaderboard
+
+FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+FIELDS = {
+    "votes": ("time", "user_id", "game_name", "category", "hidden"),
+    "tallies": ("category", "rank", "game_name", "votes"),
+    "voters": ("category", "game_name", "user_id", "user_name", "hidden"),
+}
+# Users or games copied from the store per lock acquisition
+CHUNK_SIZE = 1000
+# Size of the pieces of output handed to the response or the file
+BUFFER_SIZE = 64 * 1024
+
+
+def get_category(name: str | None) -> str | None:
+    """Category named in a request, "Free" being the one without a genre."""
+    if not name or name.capitalize() == "Free":
+        return None
+    for genre in config.votes_per_genre_per_user:
+        if genre.lower() == name.lower():
+            return genre
+    raise Exception(f"Unknown category {name!r}")
+
+
+def format_category(category: str | None) -> str:
+    return category or "Free"
+
+
+def to_utc(time: datetime.datetime) -> datetime.datetime:
+    if time.tzinfo is None:
+        return time.replace(tzinfo=datetime.timezone.utc)
+    return time
+
+
+def is_in_range(
+    time: datetime.datetime,
+    since: datetime.datetime | None,
+    until: datetime.datetime | None,
+) -> bool:
+    time = to_utc(time)
+    return (since is None or time >= since) and (until is None or time < until)
+
+
+def get_categories(category=MISSING) -> list[str | None]:
+    if category is not MISSING:
+        return [category]
+    return [None, *config.votes_per_genre_per_user]
+
+
+def iter_votes(
+    leaderboard: Leaderboard,
+    category=MISSING,
+    since: datetime.datetime | None = None,
+    until: datetime.datetime | None = None,
+) -> t.Iterator[dict]:
+    """
+    Votes for games of the catalog, optionally of one category and cast in
+    [since, until). Writers are only held off while copying a chunk of users,
+    votes of users who voted in the meantime may be missing.
+    """
+    store = leaderboard.store
+    with store.lock:
+        user_ids = list(store.by_user)
+    for start in range(0, len(user_ids), CHUNK_SIZE):
+        rows = []
+        with store.lock:
+            for user_id in user_ids[start : start + CHUNK_SIZE]:
+                for vote in store.by_user.get(user_id, {}).values():
+                    vote_category = leaderboard.get_category(vote.game_name)
+                    if vote_category is MISSING or (
+                        category is not MISSING and vote_category != category
+                    ):
+                        continue
+                    if not is_in_range(vote.time, since, until):
+                        continue
+                    rows.append(
+                        {
+                            "time": vote.time.isoformat(),
+                            "user_id": vote.user_id,
+                            "game_name": vote.game_name,
+                            "category": format_category(vote_category),
+                            "hidden": vote.hidden,
+                        }
+                    )
+        yield from rows
+
+
+def iter_tallies(
+    leaderboard: Leaderboard,
+    category=MISSING,
+    since: datetime.datetime | None = None,
+    until: datetime.datetime | None = None,
+) -> t.Iterator[dict]:
+    for current in get_categories(category):
+        if since is None and until is None:
+            top = leaderboard.get_top(current)
+        else:
+            # One count per game, however many votes there are
+            scores = {}
+            for vote in iter_votes(leaderboard, current, since, until):
+                scores[vote["game_name"]] = scores.get(vote["game_name"], 0) + 1
+            top = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        for rank, (game_name, score) in enumerate(top, start=1):
+            yield {
+                "category": format_category(current),
+                "rank": rank,
+                "game_name": game_name,
+                "votes": score,
+            }
+
+
+def iter_voters(
+    leaderboard: Leaderboard,
+    category=MISSING,
+    since: datetime.datetime | None = None,
+    until: datetime.datetime | None = None,
+) -> t.Iterator[dict]:
+    """Voters of each game, games in ranking order."""
+    store = leaderboard.store
+    user_names = discord.get_user_names()
+    for current in get_categories(category):
+        game_names = [
+            game_name for game_name, _ in leaderboard.get_top(current)
+        ]
+        for start in range(0, len(game_names), CHUNK_SIZE):
+            rows = []
+            with store.lock:
+                for game_name in game_names[start : start + CHUNK_SIZE]:
+                    for vote in store.by_game.get(game_name, {}).values():
+                        if not is_in_range(vote.time, since, until):
+                            continue
+                        rows.append(
+                            {
+                                "category": format_category(current),
+                                "game_name": game_name,
+                                "user_id": vote.user_id,
+                                "user_name": user_names.get(vote.user_id),
+                                "hidden": vote.hidden,
+                            }
+                        )
+            yield from rows
+
+
+EXPORTS = {"votes": iter_votes, "tallies": iter_tallies, "voters": iter_voters}
+
+
+class Line:
+    """File-like object returning what is written, for csv writers."""
+
+    def write(self, value: str) -> str:
+        return value
+
+
+def format_rows(
+    rows: t.Iterable[dict], fields: t.Sequence[str], format: str
+) -> t.Iterator[str]:
+    if format == "ndjson":
+        for row in rows:
+            yield json.dumps(row, ensure_ascii=False) + "\n"
+    elif format == "csv":
+        writer = csv.writer(Line())
+        yield writer.writerow(fields)
+        for row in rows:
+            yield writer.writerow([row[field] for field in fields])
+    else:
+        raise Exception(f"Unknown export format {format!r}")
+
+
+def buffer(lines: t.Iterable[str], size=BUFFER_SIZE) -> t.Iterator[bytes]:
+    """Lines joined into pieces of about `size` bytes."""
+    pending = []
+    pending_size = 0
+    for line in lines:
+        pending.append(line)
+        pending_size += len(line)
+        if pending_size >= size:
+            yield "".join(pending).encode()
+            pending.clear()
+            pending_size = 0
+    if pending:
+        yield "".join(pending).encode()
+
+
+def export(
+    kind: str,
+    leaderboard: Leaderboard,
+    format: str = "ndjson",
+    category: str | None = None,
+    since: datetime.datetime | None = None,
+    until: datetime.datetime | None = None,
+) -> t.Iterator[bytes]:
+    """
+    Rows of an export, every category being exported when `category` is
+    None. Arguments are checked right away, rows are only read as the result
+    is iterated.
+    """
+    if kind not in EXPORTS:
+        raise Exception(f"Unknown export {kind!r}")
+    if format not in FORMATS:
+        raise Exception(f"Unknown export format {format!r}")
+    rows = EXPORTS[kind](
+        leaderboard,
+        MISSING if category is None else get_category(category),
+        since and to_utc(since),
+        until and to_utc(until),
+    )
+    return buffer(format_rows(rows, FIELDS[kind], format))
+
+
+def read_leaderboard(year: int | None = None) -> Leaderboard:
+    """
+    Leaderboard of the votes of a year as they are now, read without writing
+    to the store, unlike the site's.
+    """
+    games_by_name = catalog.get(year).games_by_name
+    if not year or year == config.year:
+        store = vote_store.open_store(config.vote_store)
+    else:
+        store = vote_store.open_store(
+            "log", path=vote_store.get_archive_path(year), read_only=True
+        )
+    leaderboard = Leaderboard(
+        store,
+        lambda game_name: (
+            games_by_name[game_name].category
+            if game_name in games_by_name
+            else MISSING
+        ),
+    )
+    leaderboard.rebuild()
+    return leaderboard
+
+
+def parse_time(value: str) -> datetime.datetime:
+    """ISO 8601 time, in UTC unless it says otherwise."""
+    return to_utc(datetime.datetime.fromisoformat(value))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("kind", choices=EXPORTS)
+    parser.add_argument("--format", choices=FORMATS, default="ndjson")
+    parser.add_argument("--year", type=int, default=None)
+    parser.add_argument("--category", help="Free, or one of the genres")
+    parser.add_argument("--since", type=parse_time, help="ISO 8601 time")
+    parser.add_argument("--until", type=parse_time, help="ISO 8601 time")
+    parser.add_argument(
+        "--output", "-o", help="File to write, by default stdout"
+    )
+    args = parser.parse_args()
+
+    # Keeping stdout for the export
+    with contextlib.redirect_stdout(sys.stderr):
+        chunks = export(
+            args.kind,
+            read_leaderboard(args.year),
+            format=args.format,
+            category=args.category,
+            since=args.since,
+            until=args.until,
+        )
+    if args.output:
+        with open(args.output, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+    else:
+        for chunk in chunks:
+            sys.stdout.buffer.write(chunk)
@@ -1,34 +1,147 @@
 # From: https://github.com/Tina-otoge/withoutbait-web/blob/master/app/cli/igdb_seed.py  # noqa: E501
 
+import contextlib
 import dataclasses
 import datetime
+import fcntl
+import json
+import os
+import threading
+import time
 import typing as t
 from enum import Enum
+from pathlib import Path
 
 import requests
 from pydantic import BaseModel as Model
 
+from app import VAR_DIR
+
 API_URL = "https://api.igdb.com/v4/"
 TWITCH_AUTH_URL = "https://id.twitch.tv/oauth2/token"
+# https://api-docs.igdb.com/#rate-limits
+REQUESTS_PER_SECOND = 4
+MAX_OPEN_REQUESTS = 8
+# https://api-docs.igdb.com/#multi-query
+MAX_SUBQUERIES = 10
+MAX_LIMIT = 500
+# Twitch app tokens by client id, shared by every process
+TOKEN_PATH = VAR_DIR / "twitch_tokens.json"
+# Tokens are replaced this long before they expire, or halfway through their
+# lifetime for short-lived ones
+TOKEN_REFRESH_MARGIN = 24 * 3600
+
+
+class RateLimiter:
+    """
+    Token bucket letting through `rate` calls per second on average, in
+    bursts of up to `burst` calls. Thread-safe, callers sleep their turn.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            # Reserve a token even if none is left, to wait for it in turn
+            self._tokens -= 1
+            wait = -self._tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+@contextlib.contextmanager
+def locked(path: Path):
+    """Hold an exclusive lock on a file, shared with other processes."""
+    with path.open("a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def read_tokens(path: Path) -> dict[str, dict]:
+    try:
+        with path.open() as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def write_tokens(path: Path, tokens: dict[str, dict]):
+    tmp_path = path.with_suffix(".tmp")
+    # Readable by the owner only, like the secrets they are
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        json.dump(tokens, f)
+    os.replace(tmp_path, path)
 
 
 class API:
-    def __init__(self, client_id, client_secret, session=None):
+    def __init__(
+        self,
+        client_id,
+        client_secret,
+        session=None,
+        rate_limiter=None,
+        api_url=None,
+        auth_url=None,
+        token_path=TOKEN_PATH,
+    ):
         self.client_id = client_id
         self.client_secret = client_secret
-        self._auth_token = None
+        self.api_url = api_url or API_URL
+        self.auth_url = auth_url or TWITCH_AUTH_URL
+        self.token_path = token_path
+        self._auth_token: dict | None = None
         self.session = session or requests.Session()
+        self.rate_limiter = rate_limiter or RateLimiter(REQUESTS_PER_SECOND)
 
     @property
     def auth_token(self):
-        if self._auth_token:
-            return self._auth_token
+        if self._auth_token and time.time() < self._auth_token["refresh_at"]:
+            return self._auth_token["access_token"]
+        self.refresh_auth_token()
+        return self._auth_token["access_token"]
 
+    def refresh_auth_token(self, rejected: str = None):
+        """
+        Replace the current token by the one saved by another process if it
+        is still fresh, or else by a new one. A `rejected` token is replaced
+        even if it looks fresh.
+        """
+        if not self.token_path:
+            self._auth_token = self.fetch_auth_token()
+            return
+        with locked(self.token_path.with_suffix(".lock")):
+            tokens = read_tokens(self.token_path)
+            token = tokens.get(self.client_id)
+            if (
+                not token
+                or time.time() >= token["refresh_at"]
+                or token["access_token"] == rejected
+            ):
+                token = tokens[self.client_id] = self.fetch_auth_token()
+                write_tokens(self.token_path, tokens)
+        self._auth_token = token
+
+    def fetch_auth_token(self) -> dict:
         if not self.client_id or not self.client_secret:
             raise Exception("Missing Twitch client_id or client_secret")
 
+        # Not through the session, which may be caching responses
         response = requests.post(
-            TWITCH_AUTH_URL,
+            self.auth_url,
             {
                 "client_id": self.client_id,
                 "client_secret": self.client_secret,
@@ -36,21 +149,91 @@ class API:
             },
         )
         response.raise_for_status()
-        self._auth_token = response.json()["access_token"]
-        return self.auth_token
+        data = response.json()
+        now = time.time()
+        margin = min(TOKEN_REFRESH_MARGIN, data["expires_in"] / 2)
+        return {
+            "access_token": data["access_token"],
+            "expires_at": now + data["expires_in"],
+            "refresh_at": now + data["expires_in"] - margin,
+        }
 
     def request(self, endpoint: str, *commands: str):
-        result = self.session.post(
-            f"{API_URL}{endpoint}",
-            ";".join(commands) + ";",
+        return self.post(endpoint, ";".join(commands) + ";")
+
+    def post(self, endpoint: str, body: str):
+        token = self.auth_token
+        result = self._post(endpoint, body, token)
+        if result.status_code == 401:
+            # Revoked before expiring
+            self.refresh_auth_token(rejected=token)
+            result = self._post(endpoint, body, self.auth_token)
+        if not result.ok:
+            raise Exception(result.content.decode())
+        return result.json()
+
+    def _post(self, endpoint: str, body: str, token: str):
+        self.rate_limiter.acquire()
+        return self.session.post(
+            f"{self.api_url}{endpoint}",
+            body,
             headers={
-                "Authorization": f"Bearer {self.auth_token}",
+                "Authorization": f"Bearer {token}",
                 "Client-ID": self.client_id,
             },
         )
-        if not result.ok:
-            raise Exception(result.content.decode())
-        return result.json()
+
+    def multiquery(
+        self, queries: dict[str, tuple[str, t.Sequence[str]]]
+    ) -> dict[str, list | int]:
+        """
+        Results of several queries by name, each query being the endpoint and
+        commands `request` would take. Queries are sent up to MAX_SUBQUERIES
+        per request, count endpoints ("games/count") give a count.
+        """
+        results = {}
+        items = list(queries.items())
+        for start in range(0, len(items), MAX_SUBQUERIES):
+            body = ""
+            for name, (endpoint, commands) in items[
+                start : start + MAX_SUBQUERIES
+            ]:
+                if '"' in name:
+                    raise Exception(f"Invalid query name {name!r}")
+                commands = "".join(
+                    f"{command};" for command in commands if command
+                )
+                body += f'query {endpoint} "{name}" {{{commands}}};'
+            for item in self.post("multiquery", body):
+                results[item["name"]] = item.get("result", item.get("count"))
+        return results
+
+    def get_by_slugs(
+        self, endpoint: str, slugs: t.Iterable[str], fields: str
+    ) -> dict[str, dict]:
+        """
+        Data of the items with the given slugs, in as few requests as
+        possible. Slugs that match nothing are left out.
+        """
+        slugs = list(dict.fromkeys(slug.replace('"', "") for slug in slugs))
+        if "slug" not in fields.replace(" ", "").split(","):
+            fields += ", slug"
+        queries = {}
+        for start in range(0, len(slugs), MAX_LIMIT):
+            chunk = slugs[start : start + MAX_LIMIT]
+            queries[f"slugs {start}"] = (
+                endpoint,
+                (
+                    f"fields {fields}",
+                    "where slug = (" + ",".join(f'"{x}"' for x in chunk) + ")",
+                    f"limit {len(chunk)}",
+                ),
+            )
+        return {
+            item["slug"]: item
+            for result in self.multiquery(queries).values()
+            for item in result
+        }
 
     class Platform(Model):
         id: int
@@ -118,6 +301,14 @@ class API:
             return None
         return self.Game(**data[0])
 
+    def get_games_by_slugs(self, slugs: t.Iterable[str]) -> dict[str, Game]:
+        return {
+            slug: self.Game(**data)
+            for slug, data in self.get_by_slugs(
+                "games", slugs, self.Game.FIELDS
+            ).items()
+        }
+
     def get_games(self, query, safe=False, limit=100, match=True) -> list[Game]:
         """
         match: If True, only return games where the query is inside the title or
@@ -168,6 +359,8 @@ if __name__ == "__main__":
     api = API(
         config.igdb.client_id,
         config.igdb.client_secret,
+        api_url=config.igdb.api_url,
+        auth_url=config.igdb.auth_url,
     )
     json.dump(
         api.request(
@@ -0,0 +1,200 @@
+"""
+Votes added in bulk, for migrations and load rehearsals:
+
+- import: add the votes of a file, checked against the catalog and the quotas
+  like votes cast on the site. Rejected votes are reported, the others are
+  committed together, in a single transaction.
+- replay: apply the records of a vote log again, at a given rate, to
+  reproduce the traffic it was written by.
+
+    python -m app.ingest import PATH [--rejects FILE]
+    python -m app.ingest replay PATH [--rate OPS_PER_SECOND]
+
+Imported files are vote logs (.log), legacy YAML votes (.yml), CSV (.csv)
+or NDJSON votes (anything else), such as the votes exported by app.export.
+
+Votes are written to the live vote store. With the "log" vote store, which a
+single process may use, both commands refuse to run while the site is up: a
+running site would never see the votes, and let their users vote again. Stop
+the site first, or use the "sqlite" vote store, which the site keeps up with.
+"""
+
+import csv
+import json
+import statistics
+import time
+import typing as t
+from argparse import ArgumentParser
+from concurrent.futures import Future, wait
+from pathlib import Path
+
+import yaml
+
+from app import vote_store, votes
+from app.models.vote import Vote
+
+
+def read_votes(path: Path) -> t.Iterator[dict | str]:
+    """Votes of a file, or the lines that could not be read as JSON."""
+    if path.suffix == ".log":
+        # Read without opening a store, the log may be another year's or
+        # belong to a running site
+        source = vote_store.LogVoteStore(path)
+        for record in source.read():
+            source.apply(record, notify=False)
+        for vote in source:
+            yield vote.model_dump(mode="json")
+    elif path.suffix in (".yml", ".yaml"):
+        with path.open() as f:
+            yield from yaml.safe_load(f) or []
+    elif path.suffix == ".csv":
+        with path.open(newline="") as f:
+            yield from csv.DictReader(f)
+    else:
+        with path.open() as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    yield line
+
+
+def import_votes(items: t.Iterable[dict | str]) -> tuple[int, list[tuple]]:
+    """
+    Add votes, returning how many were accepted and the rejected ones along
+    with the reason. Runs as a single job of the writer, so that accepted
+    votes are made durable together, or not at all if that fails.
+    """
+    return votes.writer.submit(_import_votes, items).result()
+
+
+def _import_votes(items: t.Iterable[dict | str]) -> tuple[int, list[tuple]]:
+    accepted = 0
+    rejects = []
+    for item in items:
+        try:
+            if not isinstance(item, dict):
+                raise Exception("Invalid JSON")
+            votes.add_vote(Vote.model_validate(item))
+        except Exception as e:
+            rejects.append((item, str(e)))
+        else:
+            accepted += 1
+    return accepted, rejects
+
+
+def submit(record: dict) -> Future:
+    op = record["op"]
+    user_id, game_name = record["user_id"], record["game_name"]
+    if op == "add":
+        # Cast now, as part of the traffic being reproduced
+        vote = Vote(
+            game_name=game_name,
+            user_id=user_id,
+            hidden=record.get("hidden", False),
+        )
+        return votes.writer.submit(votes.add_vote, vote)
+    if op == "delete":
+        return votes.writer.submit(
+            votes.store.delete, user_id=user_id, game_name=game_name
+        )
+    if op == "hide":
+        return votes.writer.submit(
+            votes.store.set_hidden,
+            user_id=user_id,
+            game_name=game_name,
+            hidden=record["hidden"],
+        )
+    raise ValueError(f"Unknown vote record operation {op!r}")
+
+
+def replay(records: t.Iterable[dict], rate: float = 0) -> dict:
+    """
+    Submit records to the writer `rate` per second, or as fast as possible
+    with a rate of 0, without waiting for the previous ones like concurrent
+    users wouldn't. Returns the number of operations and errors, and the
+    latencies of the operations.
+    """
+    latencies = []
+    futures = []
+
+    def on_done(future: Future, submitted_at: float):
+        latencies.append(time.monotonic() - submitted_at)
+
+    start = time.monotonic()
+    for i, record in enumerate(records):
+        if rate:
+            delay = start + i / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        submitted_at = time.monotonic()
+        future = submit(record)
+        future.add_done_callback(lambda f, at=submitted_at: on_done(f, at))
+        futures.append(future)
+    wait(futures)
+    elapsed = time.monotonic() - start
+    errors = sum(1 for future in futures if future.exception())
+    percentiles = (
+        statistics.quantiles(latencies, n=100) if len(latencies) > 1 else None
+    )
+    return {
+        "operations": len(futures),
+        "errors": errors,
+        "seconds": elapsed,
+        "p50": percentiles[49] if percentiles else None,
+        "p99": percentiles[98] if percentiles else None,
+    }
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    import_parser = subparsers.add_parser(
+        "import", help="Add the votes of a file, checked like site votes"
+    )
+    import_parser.add_argument("path", type=Path)
+    import_parser.add_argument(
+        "--rejects", type=Path, help="NDJSON file to write rejected votes to"
+    )
+    replay_parser = subparsers.add_parser(
+        "replay", help="Apply the records of a vote log again"
+    )
+    replay_parser.add_argument("path", type=Path)
+    replay_parser.add_argument(
+        "--rate",
+        type=float,
+        default=0,
+        help="Operations per second, 0 for as fast as possible",
+    )
+    args = parser.parse_args()
+
+    if args.command == "import":
+        start = time.monotonic()
+        accepted, rejects = import_votes(read_votes(args.path))
+        print(
+            f"Imported {accepted} votes from {args.path} in "
+            f"{time.monotonic() - start:.2f}s, rejected {len(rejects)}"
+        )
+        for item, reason in rejects[:10]:
+            print(f"Rejected {item}: {reason}")
+        if args.rejects:
+            with args.rejects.open("w") as f:
+                for item, reason in rejects:
+                    f.write(json.dumps({"vote": item, "reason": reason}))
+                    f.write("\n")
+            print(f"Wrote rejected votes to {args.rejects}")
+    elif args.command == "replay":
+        stats = replay(vote_store.LogVoteStore(args.path).read(), args.rate)
+        print(
+            f"Replayed {stats['operations']} operations in "
+            f"{stats['seconds']:.2f}s "
+            f"({stats['operations'] / stats['seconds']:.0f}/s), "
+            f"{stats['errors']} errors"
+        )
+        if stats["p50"] is not None:
+            print(
+                f"Latency p50 {stats['p50'] * 1000:.1f}ms, "
+                f"p99 {stats['p99'] * 1000:.1f}ms"
+            )
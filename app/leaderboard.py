@@ -0,0 +1,122 @@
+import heapq
+import typing as t
+
+from app.models.vote import Vote
+from app.vote_store import VoteStore
+
+MISSING = object()
+
+
+class Leaderboard:
+    """
+    Vote tallies kept up to date from the changes of a vote store:
+
+    - scores: votes per game, per category (None being the free category)
+    - voters: user ids of the non-hidden voters of each game
+    - participants: votes per user, across all categories
+    - ballots: votes per category, per user
+
+    `get_category` maps a game name to its category, or MISSING for games
+    absent from the catalog. The tallies are only built on `rebuild`, which
+    must be called again whenever categories change.
+    """
+
+    def __init__(
+        self,
+        store: VoteStore,
+        get_category: t.Callable[[str], str | None],
+    ):
+        self.store = store
+        self.get_category = get_category
+        self.scores: dict[str | None, dict[str, int]] = {}
+        self.voters: dict[str, dict[str, None]] = {}
+        self.participants: dict[str, int] = {}
+        self.ballots: dict[str, dict[str | None, int]] = {}
+        self.ready = False
+        store.listeners.append(self.on_change)
+
+    def rebuild(self):
+        with self.store.lock:
+            self.scores.clear()
+            self.voters.clear()
+            self.participants.clear()
+            self.ballots.clear()
+            for vote in self.store:
+                self.add(vote)
+            self.ready = True
+
+    def on_change(self, op: str, vote: Vote | None):
+        if not self.ready:
+            return
+        if op == "load":
+            self.rebuild()
+        elif op == "add":
+            self.add(vote)
+        elif op == "delete":
+            self.remove(vote)
+        elif op == "hide":
+            if vote.hidden:
+                self.voters.get(vote.game_name, {}).pop(vote.user_id, None)
+            else:
+                self.voters.setdefault(vote.game_name, {})[vote.user_id] = None
+
+    def add(self, vote: Vote):
+        self.participants[vote.user_id] = (
+            self.participants.get(vote.user_id, 0) + 1
+        )
+        category = self.get_category(vote.game_name)
+        if category is MISSING:
+            return
+        ballot = self.ballots.setdefault(vote.user_id, {})
+        ballot[category] = ballot.get(category, 0) + 1
+        scores = self.scores.setdefault(category, {})
+        scores[vote.game_name] = scores.get(vote.game_name, 0) + 1
+        voters = self.voters.setdefault(vote.game_name, {})
+        if not vote.hidden:
+            voters[vote.user_id] = None
+
+    def remove(self, vote: Vote):
+        # Counted under another category if the catalog changed since, until
+        # the rebuild that follows catalog reloads
+        self.participants[vote.user_id] = (
+            self.participants.get(vote.user_id, 0) - 1
+        )
+        if self.participants[vote.user_id] <= 0:
+            del self.participants[vote.user_id]
+        category = self.get_category(vote.game_name)
+        if category is MISSING:
+            return
+        ballot = self.ballots.get(vote.user_id, {})
+        if ballot.get(category, 0) > 1:
+            ballot[category] -= 1
+        else:
+            ballot.pop(category, None)
+            if not ballot:
+                self.ballots.pop(vote.user_id, None)
+        scores = self.scores.get(category, {})
+        if scores.get(vote.game_name, 0) > 1:
+            scores[vote.game_name] -= 1
+            self.voters.get(vote.game_name, {}).pop(vote.user_id, None)
+        else:
+            scores.pop(vote.game_name, None)
+            self.voters.pop(vote.game_name, None)
+
+    def get_top(self, category=None, limit=None) -> list[tuple[str, int]]:
+        with self.store.lock:
+            scores = self.scores.get(category, {})
+            if limit is None:
+                return sorted(
+                    scores.items(), key=lambda item: item[1], reverse=True
+                )
+            return heapq.nlargest(
+                limit, scores.items(), key=lambda item: item[1]
+            )
+
+    def get_voters(self, game_name: str) -> list[str]:
+        with self.store.lock:
+            return list(self.voters.get(game_name, ()))
+
+    def get_ballot(self, user_id: str) -> dict[str | None, int]:
+        """Votes of a user per category, not counting unknown games."""
+        with self.store.lock:
+            return dict(self.ballots.get(user_id, ()))
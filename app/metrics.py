@@ -0,0 +1,164 @@
+import contextlib
+import random
+import threading
+import time
+import typing as t
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Every metric, in the order they are rendered
+metrics: list["Metric"] = []
+
+
+def format_labels(labels: tuple[tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    values = ",".join(
+        f'{name}="{escape_label(value)}"' for name, value in labels
+    )
+    return "{" + values + "}"
+
+
+def escape_label(value) -> str:
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace('"', '\\"')
+        .replace("\n", "\\n")
+    )
+
+
+class Metric:
+    type: str
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+        metrics.append(self)
+
+    def render(self) -> t.Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.type}"
+        yield from self.render_samples()
+
+    def render_samples(self) -> t.Iterator[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help)
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render_samples(self):
+        for labels, value in list(self.values.items()):
+            yield f"{self.name}{format_labels(labels)} {value}"
+
+
+class Collected(Metric):
+    """Values read when rendering, from a function returning them by labels."""
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        collect: t.Callable[[], dict[tuple, float]],
+        type="gauge",
+    ):
+        super().__init__(name, help)
+        self.collect = collect
+        self.type = type
+
+    def render_samples(self):
+        for labels, value in self.collect().items():
+            yield f"{self.name}{format_labels(labels)} {value}"
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, buckets=BUCKETS):
+        super().__init__(name, help)
+        self.buckets = buckets
+        # Count of each bucket, then the sum and count of observations
+        self.values: dict[tuple, list[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self.values.get(key)
+            if values is None:
+                values = self.values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values[i] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render_samples(self):
+        with self._lock:
+            items = [(key, list(values)) for key, values in self.values.items()]
+        for labels, values in items:
+            for bound, count in zip(self.buckets, values):
+                bucket_labels = format_labels((*labels, ("le", str(bound))))
+                yield f"{self.name}_bucket{bucket_labels} {count}"
+            inf_labels = format_labels((*labels, ("le", "+Inf")))
+            yield f"{self.name}_bucket{inf_labels} {values[-1]}"
+            yield f"{self.name}_sum{format_labels(labels)} {values[-2]}"
+            yield f"{self.name}_count{format_labels(labels)} {values[-1]}"
+
+
+def render() -> str:
+    """Every metric, in the Prometheus text format."""
+    return (
+        "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+    )
+
+
+def sample(rate: float) -> bool:
+    """Whether to log an event happening too often to log every time."""
+    return rate >= 1 or random.random() < rate
+
+
+# Metrics shared across modules, the others are next to what they measure
+request_seconds = Histogram(
+    "http_request_duration_seconds", "Time spent answering requests, by route"
+)
+# Functions returning the hits and misses of caches, by cache name
+caches: dict[str, t.Callable[[], tuple[int, int]]] = {}
+cache_requests = Collected(
+    "cache_requests_total",
+    "Lookups in in-memory caches, by cache and result",
+    lambda: {
+        (("cache", name), ("result", result)): count
+        for name, get_counts in list(caches.items())
+        for result, count in zip(("hit", "miss"), get_counts())
+    },
+    type="counter",
+)
+cache_hit_ratio = Collected(
+    "cache_hit_ratio",
+    "Share of lookups in in-memory caches that were hits, by cache",
+    lambda: {
+        (("cache", name),): hits / (hits + misses)
+        for name, get_counts in list(caches.items())
+        for hits, misses in [get_counts()]
+        if hits + misses
+    },
+)
@@ -1,5 +1,8 @@
+import dataclasses
 import datetime
 import html
+import json
+import sys
 
 from pydantic import BaseModel, Field, computed_field
 
@@ -55,3 +58,67 @@ class Game(BaseModel):
     @property
     def igdb_url(self) -> str:
         return f"https://www.igdb.com/games/{self.slug}"
+
+
+# Tuples of strings shared by the games they are equal for
+_tuples: dict[tuple[str, ...], tuple[str, ...]] = {}
+
+
+def intern_tuple(values: list[str] | None) -> tuple[str, ...] | None:
+    if values is None:
+        return None
+    values = tuple(map(sys.intern, values))
+    return _tuples.setdefault(values, values)
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class GameRecord:
+    """
+    Game as kept in a loaded catalog: read-only, without the fields only the
+    catalog files need, and with the computed fields of `Game` worked out
+    once. Strings and tuples games have in common are shared between them.
+    """
+
+    name: str
+    slug: str
+    rating: float | None
+    genres: tuple[str, ...]
+    platforms: tuple[str, ...]
+    first_release_date: datetime.date | None
+    involved_companies: tuple[str, ...] | None
+    escaped_name: str
+    genres_html: str
+    cover_url: str
+    igdb_url: str
+    # Genre of the category the game competes in, None for the free one
+    category: str | None = None
+
+    @classmethod
+    def from_game(cls, game: Game, category: str | None = None) -> "GameRecord":
+        escaped_name = game.escaped_name
+        return cls(
+            name=game.name,
+            slug=game.slug,
+            rating=game.rating,
+            genres=intern_tuple(game.genres),
+            platforms=intern_tuple(game.platforms),
+            first_release_date=game.first_release_date,
+            involved_companies=intern_tuple(game.involved_companies),
+            # Most names have nothing to escape
+            escaped_name=(
+                game.name if escaped_name == game.name else escaped_name
+            ),
+            genres_html=sys.intern(game.genres_html),
+            cover_url=game.cover_url,
+            igdb_url=game.igdb_url,
+            category=category,
+        )
+
+    def dump_json(self) -> str:
+        """JSON of the fields the front end renders search results with."""
+        return json.dumps(
+            dataclasses.asdict(self),
+            default=str,
+            ensure_ascii=False,
+            separators=(",", ":"),
+        )
@@ -0,0 +1,12 @@
+import datetime
+
+from pydantic import BaseModel, Field
+
+
+class Vote(BaseModel):
+    game_name: str
+    user_id: str = Field(coerce_numbers_to_str=True)
+    hidden: bool = False
+    time: datetime.datetime = Field(
+        default_factory=lambda: datetime.datetime.now(datetime.timezone.utc)
+    )
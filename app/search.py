@@ -0,0 +1,108 @@
+import bisect
+import heapq
+import typing as t
+from collections import Counter
+
+from rapidfuzz import fuzz, process, utils
+
+
+def get_trigrams(text: str) -> set[str]:
+    text = f" {text} "
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+class SearchIndex:
+    """
+    Fuzzy name search ranking matches with WRatio like a plain
+    `rapidfuzz.process.extract` over every name would, but only scoring a
+    shortlist of candidates:
+
+    - names, or words of names, starting with the query
+    - for queries shorter than a trigram, names containing the query
+    - otherwise, the `max_candidates` names sharing the most trigrams with the
+      query
+
+    Names are normalized with `default_process` once, when building the index.
+    When the shortlist is smaller than `limit`, every name is scored.
+    """
+
+    def __init__(
+        self,
+        names: t.Iterable[str],
+        limit: int = 12,
+        score_cutoff: float = 0,
+        max_candidates: int = 300,
+    ):
+        self.limit = limit
+        self.score_cutoff = score_cutoff
+        self.max_candidates = max_candidates
+        self.names = list(names)
+        self.processed = [utils.default_process(name) for name in self.names]
+
+        self._prefixes = sorted(
+            (word, index)
+            for index, name in enumerate(self.processed)
+            for word in {name, *name.split()}
+        )
+        self._prefix_keys = [word for word, _ in self._prefixes]
+        self._trigrams: dict[str, list[int]] = {}
+        self._trigram_counts: list[int] = []
+        for index, name in enumerate(self.processed):
+            trigrams = get_trigrams(name)
+            self._trigram_counts.append(len(trigrams))
+            for trigram in trigrams:
+                self._trigrams.setdefault(trigram, []).append(index)
+
+    def __len__(self):
+        return len(self.names)
+
+    def get_prefix_matches(self, query: str) -> set[int]:
+        start = bisect.bisect_left(self._prefix_keys, query)
+        end = bisect.bisect_left(self._prefix_keys, query + "\uffff", lo=start)
+        return {index for _, index in self._prefixes[start:end]}
+
+    def get_candidates(self, query: str) -> set[int]:
+        candidates = self.get_prefix_matches(query)
+        if len(query) < 3:
+            candidates.update(
+                index
+                for index, name in enumerate(self.processed)
+                if query in name
+            )
+        else:
+            trigrams = get_trigrams(query)
+            counts = Counter()
+            for trigram in trigrams:
+                counts.update(self._trigrams.get(trigram, ()))
+            # Relative to the shortest side, WRatio aligns the shorter string
+            # within the longer one
+            sizes = self._trigram_counts
+            candidates.update(
+                heapq.nlargest(
+                    self.max_candidates,
+                    counts,
+                    key=lambda index: (
+                        counts[index] / min(len(trigrams), sizes[index])
+                    ),
+                )
+            )
+        return candidates
+
+    def search(self, query: str) -> list[tuple[str, float]]:
+        query = utils.default_process(query)
+        if not query:
+            return []
+        candidates = self.get_candidates(query)
+        if len(candidates) < self.limit:
+            candidates = range(len(self.processed))
+        # Scored in catalog order, so that ties rank like a full scan would
+        choices = {index: self.processed[index] for index in sorted(candidates)}
+        matches = process.extract(
+            query,
+            choices,
+            scorer=fuzz.WRatio,
+            processor=None,
+            limit=self.limit,
+            score_cutoff=self.score_cutoff,
+        )
+        return [(self.names[index], score) for _, score, index in matches]
@@ -0,0 +1,160 @@
+import hashlib
+import json
+import secrets
+import time
+
+from flask import Flask, Request, Response
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+from app import database, metrics
+from app.cache import TTLCache
+
+
+def hash_session_id(session_id: str) -> str:
+    return hashlib.sha256(session_id.encode()).hexdigest()
+
+
+class SessionStore:
+    """
+    Session data by session id, expiring `ttl` seconds after being saved.
+    Stores only ever see hashes of session ids, never the ids themselves.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+
+    def get(self, key: str) -> dict | None:
+        raise NotImplementedError
+
+    def set(self, key: str, data: dict):
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        raise NotImplementedError
+
+
+class MemorySessionStore(SessionStore):
+    """Sessions of a single process, the least recently used evicted first."""
+
+    def __init__(self, ttl: float, maxsize: int = 100_000):
+        super().__init__(ttl)
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        metrics.caches["sessions"] = lambda: (
+            self.cache.hits,
+            self.cache.misses,
+        )
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, data):
+        self.cache.set(key, data)
+
+    def delete(self, key):
+        self.cache.pop(key)
+
+
+class SQLiteSessionStore(SessionStore):
+    """Sessions in the SQLite database shared by every process."""
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            id TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS sessions_expires_at
+            ON sessions (expires_at);
+    """
+
+    def __init__(self, ttl: float, path=database.DB_PATH):
+        super().__init__(ttl)
+        self.db = database.Database(path, self.schema)
+
+    def get(self, key):
+        row = self.db.execute(
+            "SELECT data FROM sessions WHERE id = ? AND expires_at > ?",
+            (key, time.time()),
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, data):
+        now = time.time()
+        with self.db.transaction(immediate=True) as db:
+            db.execute("DELETE FROM sessions WHERE expires_at <= ?", (now,))
+            db.execute(
+                "INSERT OR REPLACE INTO sessions (id, data, expires_at)"
+                " VALUES (?, ?, ?)",
+                (key, json.dumps(data), now + self.ttl),
+            )
+
+    def delete(self, key):
+        self.db.execute("DELETE FROM sessions WHERE id = ?", (key,))
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, data: dict | None, session_id: str | None):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(data, on_update)
+        self.session_id = session_id
+        self.previous_id = None
+        self.modified = False
+
+    def rotate(self):
+        """
+        Move the session to a new id, so that an id known before logging in
+        is of no use after.
+        """
+        self.previous_id = self.previous_id or self.session_id
+        self.session_id = None
+        self.modified = True
+
+
+class ServerSessionInterface(SessionInterface):
+    """
+    Flask sessions kept server side, the cookie only holding an opaque
+    session id.
+    """
+
+    def __init__(self, store: SessionStore):
+        self.store = store
+
+    def open_session(self, app: Flask, request: Request) -> ServerSession:
+        session_id = request.cookies.get(self.get_cookie_name(app))
+        if session_id:
+            data = self.store.get(hash_session_id(session_id))
+            if data is not None:
+                return ServerSession(data, session_id)
+        return ServerSession(None, None)
+
+    def save_session(
+        self, app: Flask, session: ServerSession, response: Response
+    ):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.previous_id:
+            self.store.delete(hash_session_id(session.previous_id))
+        if not session:
+            if session.session_id:
+                self.store.delete(hash_session_id(session.session_id))
+            if session.modified:
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        if not session.modified:
+            return
+        session.session_id = session.session_id or secrets.token_urlsafe(32)
+        self.store.set(hash_session_id(session.session_id), dict(session))
+        response.set_cookie(
+            name,
+            session.session_id,
+            max_age=int(self.store.ttl),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            httponly=self.get_cookie_httponly(app),
+            samesite=self.get_cookie_samesite(app),
+        )
@@ -0,0 +1,601 @@
+import contextlib
+import fcntl
+import json
+import os
+import queue
+import threading
+import time
+import typing as t
+from concurrent.futures import Future
+from pathlib import Path
+
+import yaml
+
+from app import VAR_DIR, database, metrics
+from app.models.vote import Vote
+
+LOG_PATH = VAR_DIR / "votes.log"
+YAML_PATH = VAR_DIR / "votes.yml"
+
+store_seconds = metrics.Histogram(
+    "vote_store_duration_seconds",
+    "Time spent loading and saving votes, by operation",
+)
+
+
+class VoteStore:
+    """
+    Votes kept in memory, indexed by user and by game, and persisted by a
+    backend as a sequence of records:
+
+        {"op": "add", <vote fields>}
+        {"op": "delete", "user_id": ..., "game_name": ...}
+        {"op": "hide", "user_id": ..., "game_name": ..., "hidden": ...}
+
+    Backends only have to implement `read` and `append`. Readers iterating
+    over the indexes must hold `lock`, mutations are expected to go through a
+    single `Writer`.
+    """
+
+    def __init__(self):
+        self.by_user: dict[str, dict[str, Vote]] = {}
+        self.by_game: dict[str, dict[str, Vote]] = {}
+        self.lock = threading.RLock()
+        # Called with the operation and the affected vote after each change,
+        # or with "load" and None after the whole store was (re)loaded
+        self.listeners: list[t.Callable[[str, Vote | None], None]] = []
+        self.version = 0
+        self._pending: list[dict] | None = None
+
+    def __len__(self):
+        return sum(len(votes) for votes in self.by_user.values())
+
+    def __iter__(self) -> t.Iterator[Vote]:
+        for votes in self.by_user.values():
+            yield from votes.values()
+
+    def read(self) -> t.Iterable[dict]:
+        raise NotImplementedError
+
+    def claim(self):
+        """
+        Make sure no other process writes to the store, for stores a single
+        process may use. Held until the process exits.
+        """
+
+    def append(self, records: list[dict]):
+        raise NotImplementedError
+
+    def load(self):
+        with self.lock, store_seconds.time(op="load"):
+            self.by_user.clear()
+            self.by_game.clear()
+            for record in self.read():
+                self.apply(record, notify=False)
+            self.notify("load", None)
+
+    def notify(self, op: str, vote: Vote | None):
+        self.version += 1
+        for listener in self.listeners:
+            listener(op, vote)
+
+    def apply(self, record: dict, notify=True) -> Vote | None:
+        op = record["op"]
+        user_id, game_name = record["user_id"], record["game_name"]
+        if op == "add":
+            vote = Vote.model_validate(record)
+            self.by_user.setdefault(user_id, {})[game_name] = vote
+            self.by_game.setdefault(game_name, {})[user_id] = vote
+        elif op == "delete":
+            user_votes = self.by_user.get(user_id, {})
+            game_votes = self.by_game.get(game_name, {})
+            vote = user_votes.pop(game_name, None)
+            game_votes.pop(user_id, None)
+            if not vote:
+                print(f"Ignoring vote record of a missing vote {record}")
+            if not user_votes:
+                self.by_user.pop(user_id, None)
+            if not game_votes:
+                self.by_game.pop(game_name, None)
+        elif op == "hide":
+            vote = self.get(user_id, game_name)
+            if vote:
+                vote.hidden = record["hidden"]
+            else:
+                # Such as after a vote record lost to a crash
+                print(f"Ignoring vote record of a missing vote {record}")
+        else:
+            raise ValueError(f"Unknown vote record operation {op!r}")
+        if notify and vote:
+            self.notify(op, vote)
+        return vote
+
+    def get(self, user_id: str, game_name: str) -> Vote | None:
+        return self.by_user.get(user_id, {}).get(game_name)
+
+    def get_user_votes(self, user_id: str) -> list[Vote]:
+        return list(self.by_user.get(user_id, {}).values())
+
+    def get_game_votes(self, game_name: str) -> list[Vote]:
+        return list(self.by_game.get(game_name, {}).values())
+
+    def sync(self):
+        """Catch up with the changes other processes made to a shared store."""
+
+    def commit(self, record: dict):
+        if self._pending is None:
+            with self.batch():
+                return self.commit(record)
+        with self.lock:
+            vote = self.apply(record, notify=False)
+            # Queued before listeners run, a failing one can't keep a change
+            # made in memory off the disk
+            self._pending.append(record)
+            if vote:
+                self.notify(record["op"], vote)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Hold off the writers of other processes sharing the store, for the
+        block. Changes made by those before are applied first, so that checks
+        made within the block see every vote.
+        """
+        yield
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Defer the records committed inside the block to a single append."""
+        with self.transaction():
+            self._pending = []
+            try:
+                yield
+            finally:
+                records, self._pending = self._pending, None
+                # Even if the block then failed, these are applied already
+                if records:
+                    with store_seconds.time(op="append"):
+                        self.append(records)
+
+    def add(self, vote: Vote):
+        if self.get(vote.user_id, vote.game_name):
+            raise Exception(f"Already voted for game {vote.game_name}")
+        self.commit({"op": "add", **vote.model_dump(mode="json")})
+
+    def delete(self, user_id: str, game_name: str):
+        if not self.get(user_id, game_name):
+            raise Exception(
+                f"Could not find existing vote for game {game_name}"
+            )
+        self.commit(
+            {"op": "delete", "user_id": user_id, "game_name": game_name}
+        )
+
+    def set_hidden(self, user_id: str, game_name: str, hidden: bool):
+        if not self.get(user_id, game_name):
+            raise Exception(
+                f"Could not find existing vote for game {game_name}"
+            )
+        self.commit(
+            {
+                "op": "hide",
+                "user_id": user_id,
+                "game_name": game_name,
+                "hidden": hidden,
+            }
+        )
+
+
+class LogVoteStore(VoteStore):
+    """
+    Append-only JSON lines log, which a single process may write to. The log
+    is only compacted on demand: a process still appending to the replaced
+    file would lose its votes.
+    """
+
+    def __init__(self, path: Path = LOG_PATH, read_only=False):
+        super().__init__()
+        self.path = path
+        self.read_only = read_only
+        self._file = None
+        self._records = 0
+        self._lock_file = None
+
+    def claim(self):
+        if self._lock_file:
+            return
+        lock_path = self.path.with_name(self.path.name + ".lock")
+        lock_file = lock_path.open("a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            raise Exception(
+                f"The vote log {self.path} is in use by another process, "
+                "stop the site first or use the 'sqlite' vote store"
+            )
+        self._lock_file = lock_file
+
+    def read(self):
+        if not self.path.exists():
+            return
+        with self.path.open() as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Cut short by a crash mid-write
+                    print(f"Ignoring truncated vote record {line!r}")
+                    continue
+                self._records += 1
+                yield record
+
+    def load(self):
+        self._records = 0
+        super().load()
+        if self._records > 2 * len(self) + 1000:
+            print(
+                f"Most records of {self.path} are dead, compact it with "
+                "python -m app.vote_store compact while the site is stopped"
+            )
+
+    def append(self, records: list[dict]):
+        if self.read_only:
+            raise Exception(f"The vote log {self.path} is read-only")
+        if not self._file:
+            self._file = self.path.open("a")
+            # Ending a line cut short by a crash, the records appended after
+            # it would be lost along with it otherwise
+            if self._file.tell() and not self.ends_with_newline():
+                self._file.write("\n")
+        self._file.writelines(json.dumps(record) + "\n" for record in records)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._records += len(records)
+
+    def ends_with_newline(self) -> bool:
+        with self.path.open("rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def compact(self):
+        if self.read_only:
+            raise Exception(f"The vote log {self.path} is read-only")
+        self.claim()
+        tmp_path = self.path.with_suffix(".tmp")
+        with tmp_path.open("w") as f, store_seconds.time(op="compact"):
+            for vote in self:
+                f.write(
+                    json.dumps({"op": "add", **vote.model_dump(mode="json")})
+                )
+                f.write("\n")
+            f.flush()
+            os.fsync(f.fileno())
+        if self._file:
+            self._file.close()
+            self._file = None
+        os.replace(tmp_path, self.path)
+        self._records = len(self)
+
+
+class SQLiteVoteStore(VoteStore):
+    """
+    Votes in a SQLite database, which several processes can share. Each
+    change is also recorded as an event, so that processes can catch up with
+    the changes of the others with `sync`. Events are only kept for a while:
+    a process falling behind further than that reloads the whole store.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS votes (
+            user_id TEXT NOT NULL,
+            game_name TEXT NOT NULL,
+            hidden INTEGER NOT NULL,
+            time TEXT NOT NULL,
+            PRIMARY KEY (user_id, game_name)
+        );
+        CREATE TABLE IF NOT EXISTS vote_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            record TEXT NOT NULL
+        );
+    """
+    events_kept = 100_000
+
+    def __init__(self, path: Path = database.DB_PATH):
+        super().__init__()
+        self.db = database.Database(path, self.schema)
+        self.last_event = 0
+
+    def read(self):
+        with self.db.transaction():
+            self.last_event = self.db.execute(
+                "SELECT coalesce(max(id), 0) FROM vote_events"
+            ).fetchone()[0]
+            rows = self.db.execute(
+                "SELECT user_id, game_name, hidden, time FROM votes"
+            ).fetchall()
+        for user_id, game_name, hidden, voted_at in rows:
+            yield {
+                "op": "add",
+                "user_id": user_id,
+                "game_name": game_name,
+                "hidden": bool(hidden),
+                "time": voted_at,
+            }
+
+    def sync(self):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT id, record FROM vote_events WHERE id > ? ORDER BY id",
+                (self.last_event,),
+            ).fetchall()
+            if not rows:
+                return
+            if rows[0][0] != self.last_event + 1:
+                print("Missed pruned vote events, reloading votes")
+                self.load()
+                return
+            for event_id, record in rows:
+                self.apply(json.loads(record))
+                self.last_event = event_id
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.db.transaction(immediate=True):
+            self.sync()
+            yield
+
+    def append(self, records: list[dict]):
+        with self.db.transaction(immediate=True) as db:
+            for record in records:
+                self.write(db, record)
+            db.executemany(
+                "INSERT INTO vote_events (record) VALUES (?)",
+                [(json.dumps(record),) for record in records],
+            )
+            last_event = db.execute("SELECT max(id) FROM vote_events")
+            with self.lock:
+                # Writers of other processes were held off since the last
+                # sync, there is no event of theirs to catch up with before
+                self.last_event = last_event.fetchone()[0]
+            if self.last_event % 1000 < len(records):
+                self.prune(db)
+
+    def write(self, db, record: dict):
+        op = record["op"]
+        if op == "add":
+            db.execute(
+                "INSERT INTO votes (user_id, game_name, hidden, time)"
+                " VALUES (?, ?, ?, ?)",
+                (
+                    record["user_id"],
+                    record["game_name"],
+                    record["hidden"],
+                    record["time"],
+                ),
+            )
+        elif op == "delete":
+            db.execute(
+                "DELETE FROM votes WHERE user_id = ? AND game_name = ?",
+                (record["user_id"], record["game_name"]),
+            )
+        elif op == "hide":
+            db.execute(
+                "UPDATE votes SET hidden = ? WHERE user_id = ? AND game_name = ?",
+                (record["hidden"], record["user_id"], record["game_name"]),
+            )
+
+    def prune(self, db):
+        db.execute(
+            "DELETE FROM vote_events WHERE id <= ?",
+            (self.last_event - self.events_kept,),
+        )
+
+    def compact(self):
+        with self.db.transaction(immediate=True) as db:
+            self.prune(db)
+        self.db.execute("VACUUM")
+
+
+class Writer:
+    """
+    Runs every store mutation on a single thread, so that checks made by a
+    mutation (such as vote quotas) cannot be raced past.
+
+    Mutations submitted within `window` seconds of each other are applied as
+    one batch and made durable with a single append. Each caller gets its own
+    result or exception through the returned future.
+    """
+
+    max_batch = 512
+
+    def __init__(self, store: VoteStore, window: float = 0.002):
+        self.store = store
+        self.window = window
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(
+            target=self._run, name="vote-writer", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, fn: t.Callable, *args, **kwargs) -> Future:
+        future = Future()
+        self._queue.put((future, fn, args, kwargs))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                timeout = max(deadline - time.monotonic(), 0)
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                self._process(batch)
+            except Exception as e:
+                # Never leave callers waiting, nor stop writing
+                print(f"Vote writer failed: {e}")
+                for future, _, _, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _process(self, batch):
+        results = []
+        try:
+            with self.store.batch():
+                for future, fn, args, kwargs in batch:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    try:
+                        results.append((future, fn(*args, **kwargs), None))
+                    except Exception as e:
+                        results.append((future, None, e))
+        except Exception as e:
+            # Nothing of this batch reached the disk, drop it from memory too.
+            # The batch may also have failed before running anything, such as
+            # when the database stayed locked.
+            print(f"Failed to write {len(batch)} vote operations: {e}")
+            try:
+                self.store.load()
+            except Exception as load_error:
+                print(f"Failed to reload votes: {load_error}")
+            results = [
+                (future, None, e)
+                for future, _, _, _ in batch
+                if not future.cancelled()
+            ]
+        for future, result, error in results:
+            if error:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+BACKENDS: dict[str, type[VoteStore]] = {
+    "log": LogVoteStore,
+    "sqlite": SQLiteVoteStore,
+}
+
+
+def open_store(backend: str = "log", claim=False, **kwargs) -> VoteStore:
+    """Open a store, claimed first if it is to be written to."""
+    if backend not in BACKENDS:
+        raise Exception(f"Unknown vote store backend {backend!r}")
+    store = BACKENDS[backend](**kwargs)
+    if claim:
+        store.claim()
+    store.load()
+    return store
+
+
+def get_archive_path(year: int) -> Path:
+    return VAR_DIR / f"votes_{year}.log"
+
+
+def archive(store: VoteStore, path: Path) -> int:
+    """
+    Move the votes of a store to a vote log of their own, such as once voting
+    is over, leaving the store empty for the next year.
+    """
+    if path.exists():
+        raise Exception(f"Refusing to overwrite the archive {path}")
+    with store.batch():
+        records = [
+            {"op": "add", **vote.model_dump(mode="json")} for vote in store
+        ]
+        # Made durable before any vote is deleted
+        fill(LogVoteStore(path), records)
+        for record in records:
+            store.commit(
+                {
+                    "op": "delete",
+                    "user_id": record["user_id"],
+                    "game_name": record["game_name"],
+                }
+            )
+    store.compact()
+    return len(records)
+
+
+def migrate(store: VoteStore, path: Path = YAML_PATH) -> int:
+    """
+    Import the votes of the legacy YAML file into an empty store. The file
+    is then renamed, so that it is never imported again, such as once every
+    vote was deleted or archived.
+    """
+    with path.open() as f:
+        data = yaml.safe_load(f) or []
+    records = []
+    seen = set()
+    for item in data:
+        vote = Vote(**item)
+        key = (vote.user_id, vote.game_name)
+        if key in seen:
+            print(f"Skipping duplicate vote {vote}")
+            continue
+        seen.add(key)
+        records.append({"op": "add", **vote.model_dump(mode="json")})
+    count = fill(store, records)
+    path.rename(path.with_name(path.name + ".migrated"))
+    return count
+
+
+def copy(store: VoteStore, source: VoteStore) -> int:
+    """Import the votes of another store into an empty store."""
+    return fill(
+        store,
+        [{"op": "add", **vote.model_dump(mode="json")} for vote in source],
+    )
+
+
+def fill(store: VoteStore, records: list[dict]) -> int:
+    if len(store):
+        raise Exception("Refusing to import votes into a non-empty store")
+    for record in records:
+        store.apply(record)
+    store.append(records)
+    return len(records)
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    from app.config import config
+
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = subparsers.add_parser(
+        "migrate", help="Import an existing votes.yml into the vote store"
+    )
+    migrate_parser.add_argument("path", type=Path, nargs="?", default=YAML_PATH)
+    copy_parser = subparsers.add_parser(
+        "copy", help="Import the votes of another backend into the vote store"
+    )
+    copy_parser.add_argument("backend", choices=BACKENDS)
+    subparsers.add_parser(
+        "compact", help="Drop what no longer describes live votes"
+    )
+    archive_parser = subparsers.add_parser(
+        "archive",
+        help="Move the votes to the archive of a year, once voting is over",
+    )
+    archive_parser.add_argument("--year", type=int, default=config.year)
+    args = parser.parse_args()
+
+    store = open_store(config.vote_store, claim=True)
+    if args.command == "migrate":
+        print(f"Imported {migrate(store, args.path)} votes from {args.path}")
+    elif args.command == "copy":
+        source = open_store(args.backend)
+        print(f"Imported {copy(store, source)} votes from {args.backend}")
+    elif args.command == "compact":
+        store.compact()
+        print(f"Compacted vote store down to {len(store)} votes")
+    elif args.command == "archive":
+        path = get_archive_path(args.year)
+        print(f"Archived {archive(store, path)} votes to {path}")
@@ -1,122 +1,162 @@
-import datetime
+import asyncio
 
-import yaml
-from pydantic import BaseModel, Field
-
-from app import VAR_DIR, application
+from app import catalog, logger, metrics, vote_store
+from app.cache import TTLCache
 from app.config import config
-from app.models.game import Game
+from app.leaderboard import MISSING, Leaderboard
+from app.models.vote import Vote
 
-DB_PATH = VAR_DIR / "votes.yml"
+store = vote_store.open_store(config.vote_store, claim=True)
+# Other workers starting along this one would try to migrate too
+with store.transaction():
+    if not len(store) and vote_store.YAML_PATH.exists():
+        print(f"Migrating votes from {vote_store.YAML_PATH}...")
+        print(f"Migrated {vote_store.migrate(store)} votes")
+writer = vote_store.Writer(store, window=config.vote_batch_window)
 
 
-class Vote(BaseModel):
-    game_name: str
-    user_id: str = Field(coerce_numbers_to_str=True)
-    hidden: bool = False
-    time: datetime.datetime = Field(
-        default_factory=lambda: datetime.datetime.now(datetime.timezone.utc)
-    )
+def get_category(game_name: str, year=None):
+    game = catalog.get(year).games_by_name.get(game_name)
+    if not game:
+        return MISSING
+    return game.category
 
 
-def load():
-    if not DB_PATH.exists():
-        return []
-    with DB_PATH.open() as f:
-        return [Vote(**item) for item in yaml.safe_load(f)]
+def get_quota(category: str | None) -> int:
+    if category:
+        return config.votes_per_genre_per_user[category]
+    return config.votes_per_user
 
 
-def get_top(genre=None, limit=None):
-    games = {}
-    for vote in load():
-        game = application.games_by_name[vote.game_name]
-        if genre == get_genre(game):
-            games[game.name] = games.get(game.name, 0) + 1
-    return sorted(games.items(), key=lambda item: item[1], reverse=True)
+def on_catalog_reload(reloaded: catalog.Catalog):
+    # Categories come from the catalog
+    if reloaded.year == config.year:
+        leaderboard.rebuild()
+        user_votes_cache.clear()
 
 
-def save(votes):
-    with DB_PATH.open("w") as f:
-        yaml.dump([vote.model_dump() for vote in votes], f)
+def on_vote_change(op: str, vote: Vote | None):
+    if vote is None:
+        user_votes_cache.clear()
+    else:
+        user_votes_cache.pop(vote.user_id)
+
+
+leaderboard = Leaderboard(store, get_category)
+catalog.listeners.append(on_catalog_reload)
+# Ballot summaries shown on every page, dropped when the user's votes change
+user_votes_cache = TTLCache(maxsize=config.user_votes_cache_size)
+metrics.caches["user_votes"] = lambda: (
+    user_votes_cache.hits,
+    user_votes_cache.misses,
+)
+store.listeners.append(on_vote_change)
+# Leaderboards of past years, whose votes are moved to their own log once
+# voting is over (python -m app.vote_store archive). Unloaded along with
+# their catalog, which using them keeps loaded.
+archives: dict[int, Leaderboard] = {}
+catalog.unload_listeners.append(lambda year: archives.pop(year, None))
+
+
+def get_leaderboard(year=None) -> Leaderboard:
+    if not year or year == config.year:
+        store.sync()
+        return leaderboard
+    catalog.get(year)
+    archive = archives.get(year)
+    if archive is None:
+        path = vote_store.get_archive_path(year)
+        if not path.exists():
+            raise Exception(f"No votes archived for {year}")
+        archive = Leaderboard(
+            vote_store.open_store("log", path=path, read_only=True),
+            lambda game_name: get_category(game_name, year),
+        )
+        archive.rebuild()
+        archives[year] = archive
+    return archive
 
 
-def get_genre(game: Game):
-    for genre in game.genres:
-        if genre in config.votes_per_genre_per_user.keys():
-            return genre
-    return None
+async def add_async(game_name: str, user_id: str):
+    return await asyncio.wrap_future(
+        writer.submit(_add, game_name=game_name, user_id=user_id)
+    )
 
 
-def add(game_name: str, user_id: str):
-    votes = load()
-    game = application.games_by_name[game_name]
-    user_votes = get_user_votes(user_id, votes=votes)
-    vote_genre = get_genre(game)
-    if vote_genre:
-        if user_votes["genres"][vote_genre]["remaining"] == 0:
-            raise Exception(f"No more votes available for {vote_genre}")
-    elif user_votes["remaining"] == 0:
-        raise Exception("No more votes available for free section")
+def _add(game_name: str, user_id: str):
     vote = Vote(game_name=game_name, user_id=user_id)
-    print("New vote", vote)
-    votes.append(vote)
-    save(votes)
+    if metrics.sample(config.log_sample_rate):
+        logger.info(f"New vote {vote}")
+    add_vote(vote)
+
+
+def add_vote(vote: Vote):
+    """Add a vote after checking it, must run on the writer."""
+    game = catalog.get().games_by_name.get(vote.game_name)
+    if not game:
+        raise Exception(f"Unknown game {vote.game_name}")
+    if store.get(vote.user_id, vote.game_name):
+        raise Exception(f"Already voted for game {vote.game_name}")
+    used = leaderboard.get_ballot(vote.user_id).get(game.category, 0)
+    if used >= get_quota(game.category):
+        if game.category:
+            raise Exception(f"No more votes available for {game.category}")
+        raise Exception("No more votes available for free section")
+    store.add(vote)
 
 
-def delete(game_name: str, user_id: str):
-    votes = load()
-    for index, vote in enumerate(votes):
-        if vote.game_name == game_name and vote.user_id == user_id:
-            del votes[index]
-            break
-    else:
-        Exception(f"Could not find existing vote for game {game_name}")
-    save(votes)
+async def delete_async(game_name: str, user_id: str):
+    return await asyncio.wrap_future(
+        writer.submit(store.delete, user_id=user_id, game_name=game_name)
+    )
 
 
-def set_hidden(game_name: str, user_id: str, hidden: bool):
-    votes = load()
-    for vote in votes:
-        if vote.game_name == game_name and vote.user_id == user_id:
-            vote.hidden = hidden
-            break
-    else:
-        Exception(f"Could not find existing vote for game {game_name}")
-    save(votes)
-
-
-def get_user_votes(user_id: str, votes=None):
-    def build_vote(vote: Vote):
-        return {
-            "game": application.games_by_name[vote.game_name],
-            "time": vote.time,
-            "hidden": vote.hidden,
-        }
-
-    votes = votes or load()
-    user_votes = [build_vote(vote) for vote in votes if vote.user_id == user_id]
-    user_votes_all = [
-        vote
-        for vote in user_votes
-        if not any(
-            genre in config.votes_per_genre_per_user.keys()
-            for genre in vote["game"].genres
+async def set_hidden_async(game_name: str, user_id: str, hidden: bool):
+    return await asyncio.wrap_future(
+        writer.submit(
+            store.set_hidden,
+            user_id=user_id,
+            game_name=game_name,
+            hidden=hidden,
         )
-    ]
-    user_votes_genres = {
-        genre: [vote for vote in user_votes if genre in vote["game"].genres]
-        for genre in config.votes_per_genre_per_user.keys()
+    )
+
+
+def get_user_votes(user_id: str):
+    store.sync()
+    # Under the store lock, so that a change can't be missed between building
+    # the summary and caching it
+    with store.lock:
+        result = user_votes_cache.get(user_id)
+        if result is None:
+            result = build_user_votes(user_id)
+            user_votes_cache.set(user_id, result)
+    return result
+
+
+def build_user_votes(user_id: str):
+    games_by_name = catalog.get().games_by_name
+    with store.lock:
+        user_votes = store.get_user_votes(user_id)
+        ballot = leaderboard.get_ballot(user_id)
+    votes_by_category = {
+        category: [] for category in (None, *config.votes_per_genre_per_user)
     }
+    for vote in user_votes:
+        game = games_by_name.get(vote.game_name)
+        if not game:
+            continue
+        votes_by_category[game.category].append(
+            {"game": game, "time": vote.time, "hidden": vote.hidden}
+        )
     return {
-        "votes": user_votes_all,
-        "remaining": config.votes_per_user - len(user_votes_all),
+        "votes": votes_by_category[None],
+        "remaining": get_quota(None) - ballot.get(None, 0),
         "genres": {
             genre: {
-                "votes": votes,
-                "remaining": (
-                    config.votes_per_genre_per_user[genre] - len(votes)
-                ),
+                "votes": votes_by_category[genre],
+                "remaining": get_quota(genre) - ballot.get(genre, 0),
             }
-            for genre, votes in user_votes_genres.items()
+            for genre in config.votes_per_genre_per_user
         },
     }
@@ -0,0 +1,133 @@
+"""
+Measure how much memory a loaded catalog takes, with games kept as pydantic
+models like catalogs used to, and as catalog records. Each is measured in a
+fresh interpreter, on a synthetic catalog.
+
+    python -m benchmarks.catalog_memory [--games N]
+"""
+
+import gc
+import random
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from argparse import ArgumentParser
+from pathlib import Path
+
+from app import ROOT_DIR, catalog
+from app.models.game import Game, GameRecord
+
+GENRES = (
+    "Adventure",
+    "Indie",
+    "Music",
+    "Platform",
+    "Puzzle",
+    "Role-playing (RPG)",
+    "Shooter",
+    "Simulator",
+    "Strategy",
+)
+PLATFORMS = (
+    "PC (Microsoft Windows)",
+    "PlayStation 5",
+    "Xbox Series X|S",
+    "Nintendo Switch",
+    "Mac",
+    "Linux",
+)
+WORDS = ("Dragon", "Night", "Legend", "Star", "Souls", "Quest", "City", "Ring")
+
+
+def make_game(index: int) -> Game:
+    name = " ".join(random.sample(WORDS, 3)) + f" {index}"
+    return Game(
+        name=name,
+        slug=name.lower().replace(" ", "-"),
+        rating=random.uniform(40, 100),
+        genres=random.sample(GENRES, random.randint(1, 3)),
+        platforms=random.sample(PLATFORMS, random.randint(1, 4)),
+        first_release_date=f"2025-{random.randint(1, 12):02}-01",
+        cover=f"//images.igdb.com/igdb/image/upload/t_thumb/co{index:05}.jpg",
+        involved_companies=[
+            f"Studio {random.randrange(500)}"
+            for _ in range(random.randint(1, 3))
+        ],
+    )
+
+
+def get_rss() -> int:
+    for line in Path("/proc/self/status").read_text().splitlines():
+        if line.startswith("VmRSS:"):
+            return int(line.split()[1]) * 1024
+    raise Exception("Measuring RSS is only supported on Linux")
+
+
+def load(path: Path, records: bool) -> dict:
+    if records:
+        return {
+            game.name: GameRecord.from_game(game)
+            for game in catalog.read_compiled(path, "benchmark")
+        }
+    return {
+        game.name: game for game in catalog.read_compiled(path, "benchmark")
+    }
+
+
+def measure(path: Path, records: bool):
+    """Print the RSS and traced memory a catalog adds, in this process."""
+    gc.collect()
+    rss = get_rss()
+    games = load(path, records)
+    gc.collect()
+    rss = get_rss() - rss
+    del games
+    gc.collect()
+    # Tracing takes memory of its own, so it is measured on another load
+    tracemalloc.start()
+    games = load(path, records)
+    gc.collect()
+    print(len(games), rss, tracemalloc.get_traced_memory()[0])
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--games", type=int, default=10_000)
+    parser.add_argument("--measure", choices=("models", "records"))
+    parser.add_argument("--path", type=Path)
+    args = parser.parse_args()
+
+    if args.measure:
+        measure(args.path, records=args.measure == "records")
+        sys.exit()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / "games.jsonl"
+        catalog.write_compiled(
+            (make_game(i) for i in range(args.games)), path, "benchmark"
+        )
+        results = {}
+        for mode in ("models", "records"):
+            output = subprocess.run(
+                [
+                    sys.executable,
+                    "-m",
+                    "benchmarks.catalog_memory",
+                    "--measure",
+                    mode,
+                    "--path",
+                    path,
+                ],
+                cwd=ROOT_DIR,
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout
+            count, rss, traced = map(int, output.split()[-3:])
+            results[mode] = rss
+            print(
+                f"{mode.capitalize()}: {count} games, "
+                f"RSS +{rss / 2**20:.1f}MiB, traced {traced / 2**20:.1f}MiB"
+            )
+        print(f"RSS saved: {1 - results['records'] / results['models']:.0%}")
@@ -0,0 +1,175 @@
+"""
+Local stand-ins for the Discord and IGDB APIs, answering just enough of them
+for the site and the games download to run offline.
+"""
+
+import asyncio
+import calendar
+import random
+import re
+import socket
+import threading
+import time
+import urllib.parse
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+GENRES = (
+    "Adventure",
+    "Indie",
+    "Music",
+    "Platform",
+    "Puzzle",
+    "Role-playing (RPG)",
+    "Shooter",
+    "Simulator",
+    "Strategy",
+)
+PLATFORMS = (
+    "PC (Microsoft Windows)",
+    "PlayStation 5",
+    "Xbox Series X|S",
+    "Nintendo Switch",
+    "Mac",
+    "Linux",
+)
+WORDS = (
+    "Dragon",
+    "Night",
+    "Legend",
+    "Star",
+    "Souls",
+    "Quest",
+    "City",
+    "Ring",
+    "Hollow",
+    "Knight",
+    "Space",
+    "Rhythm",
+    "Beat",
+    "Saber",
+    "Kart",
+    "Wars",
+)
+
+
+def make_discord(latency: float = 0) -> FastAPI:
+    """
+    Discord API where the code `<id>` is exchanged for the access token
+    `token-<id>`, which belongs to the user `<id>`.
+    """
+    discord = FastAPI()
+
+    @discord.post("/api/v10/oauth2/token")
+    async def token(request: Request):
+        await asyncio.sleep(latency)
+        form = urllib.parse.parse_qs((await request.body()).decode())
+        return {
+            "access_token": f"token-{form['code'][0]}",
+            "token_type": "Bearer",
+            "expires_in": 604800,
+            "refresh_token": "refresh",
+            "scope": "email identify",
+        }
+
+    @discord.get("/api/v10/users/@me")
+    async def user(request: Request):
+        await asyncio.sleep(latency)
+        token = request.headers.get("Authorization", "")
+        if not token.startswith("Bearer token-"):
+            return JSONResponse({"message": "401: Unauthorized"}, 401)
+        user_id = token.removeprefix("Bearer token-")
+        return {
+            "id": user_id,
+            "username": f"user{user_id}",
+            "discriminator": "0",
+            "global_name": f"User {user_id}",
+            "avatar": None,
+            "mfa_enabled": False,
+            "banner": None,
+            "accent_color": None,
+            "locale": "en-US",
+            "verified": True,
+            "email": f"user{user_id}@example.com",
+            "flags": 0,
+            "premium_type": 0,
+            "public_flags": 0,
+            "avatar_decoration_data": None,
+        }
+
+    return discord
+
+
+def make_igdb_game(game_id: int, year: int) -> dict:
+    # Seeded by id, so that every run fetches the same catalog
+    rng = random.Random(game_id)
+    name = " ".join(rng.sample(WORDS, rng.randint(1, 3))) + f" {game_id}"
+    day = rng.randrange(365)
+    return {
+        "id": game_id,
+        "name": name,
+        "slug": name.lower().replace(" ", "-"),
+        "rating": rng.uniform(30, 100),
+        "genres": [
+            {"id": i, "name": x}
+            for i, x in enumerate(rng.sample(GENRES, rng.randint(1, 3)))
+        ],
+        "platforms": [
+            {"id": i, "name": x}
+            for i, x in enumerate(rng.sample(PLATFORMS, rng.randint(1, 4)))
+        ],
+        "first_release_date": (
+            calendar.timegm((year, 1, 1, 0, 0, 0)) + day * 86400
+        ),
+        "cover": {"id": game_id, "url": f"//example.com/t_thumb/{game_id}.jpg"},
+        "involved_companies": [
+            {"id": i, "company": {"id": i, "name": f"Studio {i}"}}
+            for i in rng.sample(range(200), rng.randint(1, 3))
+        ],
+        "updated_at": 1700000000 + game_id,
+    }
+
+
+def make_igdb(games: int, year: int) -> FastAPI:
+    """Twitch authentication and IGDB games endpoint, with `games` games."""
+    igdb = FastAPI()
+
+    @igdb.post("/oauth2/token")
+    async def token():
+        return {
+            "access_token": "igdb",
+            "expires_in": 5000000,
+            "token_type": "bearer",
+        }
+
+    @igdb.post("/v4/games")
+    async def get_games(request: Request):
+        query = (await request.body()).decode()
+        limit = int(re.search(r"limit (\d+)", query).group(1))
+        offset = int(re.search(r"offset (\d+)", query).group(1))
+        return [
+            make_igdb_game(game_id, year)
+            for game_id in range(offset + 1, min(offset + limit, games) + 1)
+        ]
+
+    return igdb
+
+
+def get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def serve(app: FastAPI) -> str:
+    """Run an app from a background thread, and return its base URL."""
+    port = get_free_port()
+    server = uvicorn.Server(
+        uvicorn.Config(app, port=port, log_level="warning", access_log=False)
+    )
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return f"http://127.0.0.1:{port}"
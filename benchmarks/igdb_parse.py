@@ -0,0 +1,108 @@
+"""
+Measure how long converting IGDB games data to catalog games takes, per
+record, with field paths walked for every game like downloads used to, and
+with the compiled field extractors.
+
+    python -m benchmarks.igdb_parse [--games N] [--runs N]
+"""
+
+import gc
+import random
+import statistics
+import time
+from argparse import ArgumentParser
+
+import download_games
+from app.models.game import Game
+
+
+def from_igdb_data_uncompiled(data: dict) -> Game:
+    result = {}
+    for field in download_games.fields:
+        parts = field.split(".")
+        value = data
+        for part in parts:
+            if isinstance(value, list):
+                value = [
+                    item.get(part)
+                    for item in value
+                    if item.get(part) is not None
+                ]
+            else:
+                value = value.get(part)
+            if value is None:
+                break
+        if value is not None:
+            result[parts[0]] = value
+    return Game(**result)
+
+
+def make_igdb_game(index: int) -> dict:
+    names = ("Adventure", "Shooter", "Music", "Puzzle", "Role-playing (RPG)")
+    platforms = ("PC (Microsoft Windows)", "PlayStation 5", "Nintendo Switch")
+    return {
+        "id": index,
+        "name": f"Game {index}",
+        "slug": f"game-{index}",
+        "rating": random.uniform(0, 100),
+        "genres": [
+            {"id": i, "name": name}
+            for i, name in enumerate(random.sample(names, 2))
+        ],
+        "platforms": [
+            {"id": i, "name": name}
+            for i, name in enumerate(random.sample(platforms, 2))
+        ],
+        "first_release_date": 1735689600 + 86400 * random.randrange(365),
+        "cover": {"id": index, "url": f"//images.igdb.com/t_thumb/{index}.jpg"},
+        "involved_companies": [
+            {"id": i, "company": {"id": i, "name": f"Studio {i}"}}
+            for i in range(random.randrange(4))
+        ],
+        "updated_at": 1760000000 + index,
+    }
+
+
+def measure(fn, runs: int) -> float:
+    timings = []
+    for _ in range(runs):
+        # Collections of the previous runs' games would skew timings
+        gc.collect()
+        gc.disable()
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+        gc.enable()
+    return statistics.median(timings)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    # One page of a download
+    parser.add_argument("--games", type=int, default=500)
+    parser.add_argument("--runs", type=int, default=100)
+    args = parser.parse_args()
+
+    page = [make_igdb_game(i) for i in range(args.games)]
+    expected = [from_igdb_data_uncompiled(x) for x in page]
+    assert download_games.from_igdb_page(page) == expected
+
+    results = {
+        "Uncompiled fields": lambda: [
+            from_igdb_data_uncompiled(x) for x in page
+        ],
+        "Compiled fields": lambda: [
+            download_games.from_igdb_data(x) for x in page
+        ],
+        "Compiled fields, whole page": lambda: download_games.from_igdb_page(
+            page
+        ),
+    }
+    baseline = None
+    for title, fn in results.items():
+        per_record = measure(fn, args.runs) / args.games
+        baseline = baseline or per_record
+        print(
+            f"{title}: {per_record * 1e6:.2f}us per game "
+            f"(x{baseline / per_record:.2f})"
+        )
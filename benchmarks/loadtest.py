@@ -0,0 +1,370 @@
+"""
+Load test the site on synthetic data, with Discord and IGDB replaced by local
+stand-ins so that it runs offline:
+
+- a catalog of `--games` games is downloaded from the fake IGDB
+- a vote store of `--votes` votes is generated
+- the app is started with uvicorn, and each endpoint is hammered for
+  `--duration` seconds by `--concurrency` clients
+
+Throughput and latency percentiles are compared with a baseline saved by a
+previous run with `--save-baseline`, exiting with an error on regressions.
+
+    python -m benchmarks.loadtest [--games N] [--votes N] [--save-baseline]
+"""
+
+import asyncio
+import datetime
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import typing as t
+from argparse import ArgumentParser
+from pathlib import Path
+
+import httpx
+import yaml
+
+from benchmarks import fakes
+
+ROOT_DIR = Path(__file__).parent.parent
+BASELINE_PATH = ROOT_DIR / "var" / "loadtest_baseline.json"
+YEAR = datetime.date.today().year
+
+
+class Recorder:
+    """Latencies of the requests made to each endpoint."""
+
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = {}
+        self.errors: dict[str, int] = {}
+
+    async def request(
+        self, client: httpx.AsyncClient, name: str, method: str, url: str, **kw
+    ) -> httpx.Response:
+        start = time.perf_counter()
+        response = await client.request(method, url, **kw)
+        self.latencies.setdefault(name, []).append(time.perf_counter() - start)
+        if response.status_code >= 400:
+            self.errors[name] = self.errors.get(name, 0) + 1
+        return response
+
+    def get_results(self, duration: float) -> dict[str, dict]:
+        results = {}
+        for name, latencies in self.latencies.items():
+            percentiles = statistics.quantiles(latencies, n=100)
+            results[name] = {
+                "requests": len(latencies),
+                "errors": self.errors.get(name, 0),
+                "rps": len(latencies) / duration,
+                "p50": percentiles[49] * 1000,
+                "p95": percentiles[94] * 1000,
+                "p99": percentiles[98] * 1000,
+            }
+        return results
+
+
+def write_config(data_dir: Path, discord_url: str, igdb_url: str):
+    config = {
+        "year": YEAR,
+        "debug": False,
+        "allow_viewing_results": True,
+        "catalog_reload_interval": 0,
+        # Sampled logs would be printed along the results
+        "log_sample_rate": 0,
+        "discord": {
+            "client_id": "1",
+            "client_secret": "secret",
+            "base_url": discord_url,
+        },
+        "igdb": {
+            "client_id": "1",
+            "client_secret": "secret",
+            "api_url": f"{igdb_url}/v4/",
+            "auth_url": f"{igdb_url}/oauth2/token",
+        },
+    }
+    with (data_dir / "config.yml").open("w") as f:
+        yaml.dump(config, f)
+
+
+def read_games(data_dir: Path) -> list[dict]:
+    with (data_dir / f"goty_{YEAR}_games.jsonl").open() as f:
+        f.readline()  # Header
+        return [json.loads(line) for line in f]
+
+
+def write_votes(var_dir: Path, games: list[dict], count: int, seed=0):
+    """
+    Votes of users using up their quotas, mostly for a few popular games like
+    real ballots are.
+    """
+    rng = random.Random(seed)
+    free = [game["name"] for game in games if "Music" not in game["genres"]]
+    music = [game["name"] for game in games if "Music" in game["genres"]]
+    now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    names = {}
+    with (var_dir / "votes.log").open("w") as f:
+        user_id = 0
+        while count > 0:
+            user_id += 1
+            names[str(user_id)] = f"User {user_id}"
+            ballot = set(
+                rng.choices(
+                    free, weights=[1 / (i + 1) for i in range(len(free))], k=3
+                )
+            )
+            if music:
+                ballot.add(rng.choice(music))
+            for game_name in list(ballot)[:count]:
+                record = {
+                    "op": "add",
+                    "game_name": game_name,
+                    "user_id": str(user_id),
+                    "hidden": rng.random() < 0.1,
+                    "time": now,
+                }
+                f.write(json.dumps(record) + "\n")
+                count -= 1
+    with (var_dir / "discord.yml").open("w") as f:
+        yaml.dump(names, f)
+
+
+async def wait_until_ready(base_url: str, timeout=120):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        while True:
+            try:
+                if (await client.get("/")).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            if time.monotonic() > deadline:
+                raise Exception("The app did not start in time")
+            await asyncio.sleep(0.2)
+
+
+async def log_in(client: httpx.AsyncClient, user_id: str):
+    response = await client.get(
+        "/auth/discord/callback", params={"code": user_id}
+    )
+    if response.status_code != 302:
+        raise Exception(f"Could not log in: {response.text}")
+
+
+def make_scenarios(games: list[dict]) -> dict[str, t.Callable]:
+    free = [game["name"] for game in games if "Music" not in game["genres"]]
+    words = sorted({word for game in games for word in game["name"].split()})
+
+    async def index(client, recorder, rng, user_id):
+        await recorder.request(client, "GET /", "GET", "/")
+
+    async def search(client, recorder, rng, user_id):
+        query = " ".join(
+            rng.choice(words)[: rng.randint(3, 8)]
+            for _ in range(rng.randint(1, 2))
+        )
+        await recorder.request(
+            client, "GET /api/games/", "GET", "/api/games/", params={"q": query}
+        )
+
+    async def vote(client, recorder, rng, user_id):
+        body = {
+            "game_name": rng.choice(free),
+            "discord_access_token": f"token-{user_id}",
+        }
+        for method in ("POST", "DELETE"):
+            await recorder.request(
+                client, f"{method} /api/vote/", method, "/api/vote/", json=body
+            )
+
+    async def results(client, recorder, rng, user_id):
+        await recorder.request(client, "GET /results/", "GET", "/results/")
+
+    return {"index": index, "search": search, "vote": vote, "results": results}
+
+
+async def run_scenario(
+    base_url: str,
+    scenario: t.Callable,
+    recorder: Recorder,
+    concurrency: int,
+    duration: float,
+    first_user_id: int,
+):
+    async def worker(index: int):
+        rng = random.Random(index)
+        user_id = str(first_user_id + index)
+        async with httpx.AsyncClient(base_url=base_url, timeout=30) as client:
+            await log_in(client, user_id)
+            while time.monotonic() < deadline:
+                await scenario(client, recorder, rng, user_id)
+
+    deadline = time.monotonic() + duration
+    await asyncio.gather(*(worker(i) for i in range(concurrency)))
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if result["p95"] > base["p95"] * (1 + tolerance):
+            regressions.append(
+                f"{name}: p95 {result['p95']:.1f}ms, was {base['p95']:.1f}ms"
+            )
+        if result["rps"] < base["rps"] * (1 - tolerance):
+            regressions.append(
+                f"{name}: {result['rps']:.0f} req/s, was {base['rps']:.0f}"
+            )
+        if result["errors"] and not base["errors"]:
+            regressions.append(f"{name}: {result['errors']} errors")
+    return regressions
+
+
+def print_results(results: dict):
+    print(
+        f"{'Endpoint':<22}{'Requests':>10}{'Errors':>8}{'Req/s':>9}"
+        f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+    )
+    for name, x in results.items():
+        print(
+            f"{name:<22}{x['requests']:>10}{x['errors']:>8}{x['rps']:>9.0f}"
+            f"{x['p50']:>9.1f}{x['p95']:>9.1f}{x['p99']:>9.1f}"
+        )
+
+
+def main(args):
+    discord_url = fakes.serve(fakes.make_discord(args.discord_latency))
+    igdb_url = fakes.serve(fakes.make_igdb(args.games, YEAR))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = Path(tmp_dir) / "data"
+        var_dir = Path(tmp_dir) / "var"
+        data_dir.mkdir()
+        var_dir.mkdir()
+        env = {
+            **os.environ,
+            "GOTY_DATA_DIR": str(data_dir),
+            "GOTY_VAR_DIR": str(var_dir),
+        }
+        write_config(data_dir, discord_url, igdb_url)
+
+        print(f"Downloading {args.games} games from the fake IGDB...")
+        subprocess.run(
+            [sys.executable, "download_games.py", str(YEAR), "--restart"],
+            cwd=ROOT_DIR,
+            env=env,
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        games = read_games(data_dir)
+        print(f"Generating {args.votes} votes...")
+        write_votes(var_dir, games, args.votes)
+
+        port = fakes.get_free_port()
+        base_url = f"http://127.0.0.1:{port}"
+        server = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "uvicorn",
+                "app.application:app",
+                "--port",
+                str(port),
+                "--log-level",
+                "warning",
+                "--no-access-log",
+            ],
+            cwd=ROOT_DIR,
+            env=env,
+            stdout=subprocess.DEVNULL,
+        )
+        try:
+            asyncio.run(wait_until_ready(base_url))
+            recorder = Recorder()
+            scenarios = make_scenarios(games)
+            for i, (title, scenario) in enumerate(scenarios.items()):
+                print(f"Running {title} for {args.duration}s...")
+                # Not recording the warm up, when caches are still cold
+                for run_recorder, duration in (
+                    (Recorder(), args.warmup),
+                    (recorder, args.duration),
+                ):
+                    asyncio.run(
+                        run_scenario(
+                            base_url,
+                            scenario,
+                            run_recorder,
+                            args.concurrency,
+                            duration,
+                            # Fresh users for each scenario, with empty ballots
+                            first_user_id=10**9 + i * args.concurrency,
+                        )
+                    )
+        finally:
+            server.terminate()
+            server.wait()
+
+    results = recorder.get_results(args.duration)
+    print_results(results)
+    params = {
+        "games": args.games,
+        "votes": args.votes,
+        "concurrency": args.concurrency,
+        "duration": args.duration,
+        "discord_latency": args.discord_latency,
+    }
+    if args.save_baseline:
+        args.baseline.write_text(
+            json.dumps({"params": params, "results": results}, indent=2)
+        )
+        print(f"Saved baseline to {args.baseline}")
+        return 0
+    if not args.baseline.exists():
+        return 0
+    baseline = json.loads(args.baseline.read_text())
+    if baseline["params"] != params:
+        print(f"Baseline {args.baseline} was run with {baseline['params']}")
+        return 0
+    regressions = compare(results, baseline["results"], args.tolerance)
+    for regression in regressions:
+        print(f"Regression: {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--games", type=int, default=5000, help="From 1k to 20k, typically"
+    )
+    parser.add_argument(
+        "--votes", type=int, default=10_000, help="From 1k to 100k, typically"
+    )
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument(
+        "--duration", type=float, default=10, help="Seconds per endpoint"
+    )
+    parser.add_argument(
+        "--warmup", type=float, default=2, help="Seconds before measuring"
+    )
+    parser.add_argument(
+        "--discord-latency",
+        type=float,
+        default=0.05,
+        help="Seconds the fake Discord takes to answer",
+    )
+    parser.add_argument("--baseline", type=Path, default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="Relative change from the baseline counted as a regression",
+    )
+    sys.exit(main(parser.parse_args()))
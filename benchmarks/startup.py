@@ -0,0 +1,62 @@
+"""
+Measure how long loading the games catalog and starting a worker take.
+
+    python -m benchmarks.startup [year] [--runs N]
+"""
+
+import statistics
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+
+import yaml
+
+from app import ROOT_DIR, catalog
+from app.config import config
+from app.models.game import Game
+
+
+def measure(fn, runs: int) -> float:
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def load_yaml(loader):
+    with config.get_games_path(args.year).open() as f:
+        return [Game(**game) for game in yaml.load(f, Loader=loader)]
+
+
+def start_worker():
+    subprocess.run(
+        [sys.executable, "-c", "import app.application"],
+        cwd=ROOT_DIR,
+        check=True,
+        capture_output=True,
+    )
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("year", type=int, nargs="?", default=config.year)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    catalog.compile_games(args.year)
+    source_hash = catalog.get_source_hash(config.get_games_path(args.year))
+    compiled_path = config.get_compiled_games_path(args.year)
+
+    results = {
+        "YAML, pure Python loader": lambda: load_yaml(yaml.SafeLoader),
+        "YAML, libyaml loader": lambda: load_yaml(catalog.YAMLLoader),
+        "Compiled catalog": lambda: list(
+            catalog.read_compiled(compiled_path, source_hash)
+        ),
+        "Worker start": start_worker,
+    }
+    for title, fn in results.items():
+        print(f"{title}: {measure(fn, args.runs) * 1000:.1f}ms")
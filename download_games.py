@@ -1,13 +1,20 @@
-import time
+import json
+import os
+import tempfile
+import typing as t
 from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from pathlib import Path
 
 import yaml
+from pydantic import TypeAdapter
 from requests_cache import CachedSession
 
-from app import DATA_DIR, VAR_DIR
+from app import DATA_DIR, VAR_DIR, catalog
 from app.config import config
-from app.igdb import API
+from app.igdb import API, MAX_OPEN_REQUESTS
 from app.models.game import Game
 
 fields = (
@@ -23,25 +30,249 @@ fields = (
 )
 
 
+def compile_field(field: str) -> t.Callable[[dict], t.Any]:
+    """
+    Build a function reading a dotted field of IGDB data, mapping over lists
+    and leaving out missing values, or returning None if the field is absent.
+    """
+    part, _, rest = field.partition(".")
+    if not rest:
+        return lambda data: data.get(part)
+    get_rest = compile_field(rest)
+
+    def get(data: dict):
+        value = data.get(part)
+        if value is None:
+            return None
+        if isinstance(value, list):
+            return [x for item in value if (x := get_rest(item)) is not None]
+        return get_rest(value)
+
+    return get
+
+
+# Game field and the function reading it, for each of the fetched fields
+extractors = tuple(
+    (field.partition(".")[0], compile_field(field)) for field in fields
+)
+games_adapter = TypeAdapter(list[Game])
+
+
+def get_game_data(data: dict) -> dict:
+    return {
+        key: value
+        for key, get in extractors
+        if (value := get(data)) is not None
+    }
+
+
 def from_igdb_data(data: dict) -> Game:
-    result = {}
-    for field in fields:
-        parts = field.split(".")
-        value = data
-        for part in parts:
-            if isinstance(value, list):
-                value = [
-                    item.get(part)
-                    for item in value
-                    if item.get(part) is not None
-                ]
-            else:
-                value = value.get(part)
-            if value is None:
-                break
-        if value is not None:
-            result[parts[0]] = value
-    return Game(**result)
+    return Game.model_validate(get_game_data(data))
+
+
+def from_igdb_page(page: list[dict]) -> list[Game]:
+    """Convert a page of IGDB games, validated all at once."""
+    return games_adapter.validate_python([get_game_data(x) for x in page])
+
+
+def get_where(year: int) -> str:
+    start_of_year_unix = int(datetime(year, 1, 1).timestamp())
+    end_of_year_unix = int(datetime(year, 12, 31, 23, 59, 59).timestamp())
+    return "where " + (
+        "game_type = ("
+        f"{API.Game.Category.MAIN_GAME}, {API.Game.Category.EXPANDED}"
+        ")"
+        f"& release_dates.date >= {start_of_year_unix}"
+        f"& release_dates.date <= {end_of_year_unix}"
+        # "& parent_game = null"
+        "& version_parent = null"
+    )
+
+
+def fetch_page(api: API, where: str, limit: int, offset: int) -> list[dict]:
+    return api.request(
+        "games",
+        f"fields {', '.join([*fields, 'updated_at'])}",
+        where,
+        # Stable order, so that pages do not overlap and offsets can resume
+        "sort id asc",
+        f"limit {limit}",
+        f"offset {offset}",
+    )
+
+
+class Download:
+    """
+    Games of a year being fetched from IGDB, several pages at a time, and
+    streamed to partial catalog files as the pages arrive in order.
+
+    After each page, progress is saved to a checkpoint file, so that an
+    interrupted download resumes from the last written page.
+    """
+
+    def __init__(self, year: int):
+        self.year = year
+        self.games_path = config.get_games_path(year)
+        self.compiled_path = config.get_compiled_games_path(year)
+        self.partial_games_path = Path(f"{self.games_path}.partial")
+        self.partial_compiled_path = Path(f"{self.compiled_path}.partial")
+        self.checkpoint_path = VAR_DIR / f"download_{year}.json"
+        self.offset = 0
+        self.count = 0
+        self.updated_at = 0
+
+    def load_checkpoint(self):
+        if not self.checkpoint_path.exists():
+            return
+        if not self.partial_games_path.exists():
+            return
+        checkpoint = json.loads(self.checkpoint_path.read_text())
+        self.offset = checkpoint["offset"]
+        self.count = checkpoint["count"]
+        self.updated_at = checkpoint["updated_at"]
+        # Drop whatever was written after the checkpoint
+        for path, size in (
+            (self.partial_games_path, checkpoint["games_size"]),
+            (self.partial_compiled_path, checkpoint["compiled_size"]),
+        ):
+            with path.open("r+") as f:
+                f.truncate(size)
+        print(f"Resuming from offset {self.offset} ({self.count} games)")
+
+    def save_checkpoint(self, games_file, compiled_file):
+        checkpoint = {
+            "offset": self.offset,
+            "count": self.count,
+            "updated_at": self.updated_at,
+            "games_size": games_file.tell(),
+            "compiled_size": compiled_file.tell(),
+        }
+        tmp_path = self.checkpoint_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(checkpoint))
+        tmp_path.replace(self.checkpoint_path)
+
+    def run(self, api: API, stop_at=-1, limit=500, workers=4, resume=True):
+        if resume:
+            self.load_checkpoint()
+        if not self.offset:
+            self.partial_games_path.write_text("")
+            self.partial_compiled_path.write_text("")
+        if stop_at >= 0:
+            limit = min(limit, stop_at)
+        where = get_where(self.year)
+        api.auth_token  # Authenticate once before spreading over threads
+
+        with (
+            ThreadPoolExecutor(workers) as executor,
+            self.partial_games_path.open("a") as games_file,
+            self.partial_compiled_path.open("a") as compiled_file,
+        ):
+            next_offset = self.offset
+            pages = deque()
+            done = stop_at >= 0 and self.count >= stop_at
+            while not done:
+                while len(pages) < workers:
+                    pages.append(
+                        executor.submit(
+                            fetch_page, api, where, limit, next_offset
+                        )
+                    )
+                    next_offset += limit
+                page = pages.popleft().result()
+                if stop_at >= 0:
+                    page = page[: stop_at - self.count]
+                for item, game in zip(page, from_igdb_page(page)):
+                    self.updated_at = max(self.updated_at, item["updated_at"])
+                    yaml.dump([game.model_dump(exclude_unset=True)], games_file)
+                    compiled_file.write(catalog.dump_game(game))
+                games_file.flush()
+                compiled_file.flush()
+                self.offset += limit
+                self.count += len(page)
+                self.save_checkpoint(games_file, compiled_file)
+                print(f"Fetched {self.count} games (offset={self.offset})")
+                done = len(page) < limit or (
+                    stop_at >= 0 and self.count >= stop_at
+                )
+            for future in pages:
+                future.cancel()
+
+        self.finish()
+
+    def finish(self):
+        if not self.count:
+            self.partial_games_path.write_text("[]\n")
+        self.partial_games_path.replace(self.games_path)
+        with self.partial_compiled_path.open() as f:
+            catalog.write_compiled(
+                (Game.model_validate_json(line) for line in f),
+                self.compiled_path,
+                catalog.get_source_hash(self.games_path),
+            )
+        self.partial_compiled_path.unlink()
+        self.checkpoint_path.unlink(missing_ok=True)
+        save_watermark(self.year, self.updated_at)
+        print(f"Wrote {self.count} games to {self.games_path}")
+
+
+def get_watermark_path(year: int) -> Path:
+    return VAR_DIR / f"catalog_{year}_sync.json"
+
+
+def load_watermark(year: int) -> int | None:
+    """Most recent IGDB `updated_at` of the games in the catalog of a year."""
+    path = get_watermark_path(year)
+    if not path.exists():
+        return None
+    return json.loads(path.read_text())["updated_at"]
+
+
+def save_watermark(year: int, updated_at: int):
+    get_watermark_path(year).write_text(json.dumps({"updated_at": updated_at}))
+
+
+def refresh(api: API, year: int, limit=500) -> int:
+    """
+    Fetch only the games updated on IGDB since the last sync, and merge them
+    into the existing catalog by slug. Return the number of fetched games.
+    """
+    watermark = load_watermark(year)
+    if watermark is None:
+        raise Exception(f"No previous sync for {year}, run a full download")
+    where = get_where(year) + f" & updated_at > {watermark}"
+    games = {game.slug: game for game in catalog.load_games(year)}
+    updated_at = watermark
+    count = 0
+    offset = 0
+    while True:
+        page = fetch_page(api, where, limit, offset)
+        for item, game in zip(page, from_igdb_page(page)):
+            updated_at = max(updated_at, item["updated_at"])
+            print(f"{'Updated' if game.slug in games else 'Added'} {game.name}")
+            games[game.slug] = game
+        count += len(page)
+        if len(page) < limit:
+            break
+        offset += limit
+
+    if count:
+        games_path = config.get_games_path(year)
+        # Of its own, site workers may be compiling the catalog meanwhile
+        with tempfile.NamedTemporaryFile(
+            "w", dir=games_path.parent, suffix=".yml.tmp", delete=False
+        ) as f:
+            yaml.dump(
+                [x.model_dump(exclude_unset=True) for x in games.values()], f
+            )
+        os.replace(f.name, games_path)
+        catalog.write_compiled(
+            games.values(),
+            config.get_compiled_games_path(year),
+            catalog.get_source_hash(games_path),
+        )
+    save_watermark(year, updated_at)
+    print(f"Fetched {count} updated games, {len(games)} games in catalog")
+    return count
 
 
 if __name__ == "__main__":
@@ -50,51 +281,44 @@ if __name__ == "__main__":
     parser.add_argument(
         "--stop-at", type=int, default=-1, help="Stop after N fetched games"
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Pages fetched concurrently",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only fetch games updated since the last download",
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="Ignore the checkpoint of an interrupted download",
+    )
     args = parser.parse_args()
 
     api = API(
         config.igdb.client_id,
         config.igdb.client_secret,
-        session=CachedSession(
-            VAR_DIR / "igdb_cache", allowable_methods=("POST",)
+        api_url=config.igdb.api_url,
+        auth_url=config.igdb.auth_url,
+        # Incremental refreshes are all about getting fresh data
+        session=(
+            None
+            if args.incremental
+            else CachedSession(
+                VAR_DIR / "igdb_cache", allowable_methods=("POST",)
+            )
         ),
     )
-
-    start_of_year_unix = int(datetime(args.year, 1, 1).timestamp())
-    end_of_year_unix = int(datetime(args.year, 12, 31, 23, 59, 59).timestamp())
-
-    stop_at = args.stop_at
-    results = []
-    limit = 500
-    page = 0
-    sleep = 1
-
-    limit = min(limit, stop_at) if stop_at >= 0 else limit
-    while True:
-        result = api.request(
-            "games",
-            f"fields {', '.join(fields)}",
-            "where "
-            + (
-                "game_type = ("
-                f"{API.Game.Category.MAIN_GAME}, {API.Game.Category.EXPANDED}"
-                ")"
-                f"& release_dates.date >= {start_of_year_unix}"
-                f"& release_dates.date <= {end_of_year_unix}"
-                # "& parent_game = null"
-                "& version_parent = null"
-            ),
-            f"limit {limit}",
-            f"offset {limit * page}",
+    if args.incremental:
+        refresh(api, args.year)
+    else:
+        Download(args.year).run(
+            api,
+            stop_at=args.stop_at,
+            workers=min(args.workers, MAX_OPEN_REQUESTS),
+            resume=not args.restart,
         )
-        if not result:
-            break
-        results.extend([from_igdb_data(item) for item in result])
-        print(f"Fetched {len(results)} games ({page=}), sleeping {sleep}s...")
-        if (stop_at >= 0 and len(results) >= stop_at) or len(result) < limit:
-            break
-        page += 1
-        time.sleep(sleep)
-
-    with config.get_games_path(args.year).open("w") as f:
-        yaml.dump([x.model_dump(exclude_unset=True) for x in results], f)